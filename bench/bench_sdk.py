@@ -0,0 +1,398 @@
+'''
+SDK 的基准测试，不需要网络：加解密、ECDH、消息编解码、dispatch_msg 吞吐量，
+以及对本地 websocket 模拟服务端的完整会话（hello -> 秘钥交换 -> 登录 -> 聊天）
+
+结果和 bench/baseline.json 里的基线比较，比基线慢超过阈值时返回非 0
+基线是 --update 跑几轮的中位数，同时记下各轮之间的离散程度，抖动大的项允许的变慢比例也大
+python bench/bench_sdk.py                  # 检查
+python bench/bench_sdk.py -k aes           # 只跑名字里包含 aes 的
+python bench/bench_sdk.py --update         # 跑几轮，更新基线
+
+所有结果都是越小越好：微基准为每次操作的微秒数，会话为毫秒数
+'''
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+sys.path.insert(0, ROOT)
+
+from birdtalk_sdk import msg_pb2                                  # noqa: E402
+from birdtalk_sdk.birdtalk_client import BirdTalkClient, ClientState   # noqa: E402
+from birdtalk_sdk.crypt_helper import ECDHKeyExchange             # noqa: E402
+from birdtalk_sdk.msg_template import chat_template               # noqa: E402
+
+
+@contextlib.contextmanager
+def quiet():
+    # SDK 里到处是 print，测量时丢掉输出，但格式化的开销仍然算在结果里
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def per_op_us(func, min_time=0.2, repeat=7):
+    """Best microseconds per call of func() over several timed batches."""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / repeat or number >= 1 << 20:
+            break
+        number *= 2
+    results = [elapsed / number]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        results.append((time.perf_counter() - started) / number)
+    return min(results) * 1e6    # 和 timeit 一样取最小值，受其他进程干扰最小
+
+
+##################################################################
+# 加解密
+def make_shared_pair():
+    with quiet():
+        alice, bob = ECDHKeyExchange(), ECDHKeyExchange()
+        alice.generate_key_pair()
+        bob.generate_key_pair()
+        alice.exchange_keys(bob.get_public_key())
+        bob.exchange_keys(alice.get_public_key())
+    return alice, bob
+
+
+def bench_crypto(results, select):
+    alice, _ = make_shared_pair()
+    for size in (64, 1024, 16 * 1024, 256 * 1024):
+        data = os.urandom(size)
+        cipher = alice.encrypt_aes_ctr(data)
+        run(results, select, f"aes_ctr_encrypt_{size}", lambda: alice.encrypt_aes_ctr(data))
+        run(results, select, f"aes_ctr_decrypt_{size}", lambda: alice.decrypt_aes_ctr(cipher))
+
+    def handshake():
+        with quiet():
+            a, b = ECDHKeyExchange(), ECDHKeyExchange()
+            a.generate_key_pair()
+            b.generate_key_pair()
+            a.exchange_keys(b.get_public_key())
+            b.exchange_keys(a.get_public_key())
+            a.get_int64_print()
+    run(results, select, "ecdh_handshake", handshake)
+
+
+##################################################################
+# 编解码
+def sample_messages():
+    msgs = {}
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTHello, version=1, tm=1700000000)
+    hello = m.plainMsg.hello
+    hello.clientId, hello.version, hello.platform, hello.stage = "bench-host", "1.0", "Linux", "clienthello"
+    hello.keyPrint = 1234567890123
+    hello.params["lang"] = "zh_CN"
+    hello.params["checkTokenData"] = "A" * 40
+    msgs["hello"] = m
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTHeartBeat, version=1, tm=1700000000)
+    m.plainMsg.heartBeat.tm = 1700000000
+    m.plainMsg.heartBeat.userId = 10003
+    msgs["heartbeat"] = m
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTKeyExchange, version=1, tm=1700000000)
+    alice, _ = make_shared_pair()
+    m.plainMsg.keyEx.stage = 1
+    m.plainMsg.keyEx.pubKey = alice.get_public_key()
+    m.plainMsg.keyEx.encType = "AES-CTR"
+    msgs["keyex"] = m
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTUserOp, version=1, tm=1700000000)
+    m.plainMsg.userOp.operation = msg_pb2.UserOperationType.Login
+    m.plainMsg.userOp.user.userId = 10003
+    m.plainMsg.userOp.user.params["pwd"] = "123456"
+    m.plainMsg.userOp.params["loginmode"] = "id"
+    msgs["user_op"] = m
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTChatMsg, version=1, tm=1700000000)
+    chat = m.plainMsg.chatData
+    chat.msgId, chat.fromId, chat.toId, chat.tm = 7000000000000001, 10003, 10001, 1700000000000
+    chat.sendId, chat.chatType, chat.data = 1700000000000000, msg_pb2.ChatType.ChatTypeP2P, "你好，hello".encode() * 8
+    msgs["chat"] = m
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTChatReply, version=1, tm=1700000000)
+    reply = m.plainMsg.chatReply
+    reply.msgId, reply.sendId, reply.sendOk, reply.fromId, reply.userId = 7000000000000001, 1700000000000000, 1, 1, 10003
+    msgs["chat_reply"] = m
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTQueryResult, version=1, tm=1700000000)
+    for i in range(20):
+        item = m.plainMsg.commonQueryRet.chatDataList.add()
+        item.CopyFrom(msgs["chat"].plainMsg.chatData)
+        item.msgId += i
+    msgs["query_result"] = m
+
+    m = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTUpload, version=1, tm=1700000000)
+    m.plainMsg.uploadReq.fileName = "bench.bin"
+    m.plainMsg.uploadReq.fileData = os.urandom(64 * 1024)
+    m.plainMsg.uploadReq.fileSize = 64 * 1024
+    msgs["upload_64k"] = m
+    return msgs
+
+
+def bench_codec(results, select):
+    for name, msg in sample_messages().items():
+        data = msg.SerializeToString()
+        run(results, select, f"serialize_{name}", msg.SerializeToString)
+        run(results, select, f"parse_{name}", lambda: msg_pb2.Msg.FromString(data))
+
+    tpl = chat_template(10003)
+    run(results, select, "template_chat_render",
+        lambda: tpl.render(tm=1700000000, chat_tm=1700000000000, send_id=1, to_id=10001, data=b"hello"))
+
+
+##################################################################
+# dispatch_msg 吞吐量：同样的一批帧经过 on_message，有 inbox 和没有 inbox 两种方式
+def bench_dispatch(results, select):
+    msgs = sample_messages()
+    frames = []
+    for i in range(1000):
+        m = msg_pb2.Msg()
+        m.CopyFrom(msgs["chat"] if i % 2 else msgs["chat_reply"])
+        if i % 2:
+            m.plainMsg.chatData.msgId += i
+            m.plainMsg.chatData.fromId = 10000 + i % 50
+        frames.append(m.SerializeToString())
+
+    async def feed(inbox_size):
+        with quiet():
+            client = BirdTalkClient("ws://127.0.0.1:1/ws", "bench", inbox_size=inbox_size)
+            client.set_dedup(0)
+            started = time.perf_counter()
+            for frame in frames:
+                await client.on_message(frame)
+            if client.inbox is not None:
+                await client.inbox.join()
+            return (time.perf_counter() - started) / len(frames) * 1e6
+
+    for name, inbox_size in (("dispatch_direct", 0), ("dispatch_inbox", 1000)):
+        if select(name):
+            results[name] = min(asyncio.run(feed(inbox_size)) for _ in range(5))
+            report(name, results[name])
+
+
+##################################################################
+# 完整会话：本地的 websocket 服务端模拟 hello、秘钥交换、登录，并且确认每一条聊天消息
+def _server_msg(msg_type):
+    m = msg_pb2.Msg(msgType=msg_type, version=1, tm=int(time.time()))
+    return m
+
+
+async def _serve_session(ws):
+    server_key = ECDHKeyExchange()
+    async for data in ws:
+        msg = msg_pb2.Msg.FromString(data)
+        if msg.msgType == msg_pb2.ComMsgType.MsgTHello:
+            reply = _server_msg(msg_pb2.ComMsgType.MsgTHello)
+            reply.plainMsg.hello.stage = "waitlogin"
+        elif msg.msgType == msg_pb2.ComMsgType.MsgTKeyExchange:
+            keyex = msg.plainMsg.keyEx
+            reply = _server_msg(msg_pb2.ComMsgType.MsgTKeyExchange)
+            if keyex.stage == 1:
+                with quiet():
+                    server_key.generate_key_pair()
+                    server_key.exchange_keys(keyex.pubKey)
+                reply.plainMsg.keyEx.stage = 2
+                reply.plainMsg.keyEx.pubKey = server_key.get_public_key()
+                reply.plainMsg.keyEx.keyPrint = server_key.get_int64_print()
+            else:
+                reply.plainMsg.keyEx.stage = 4
+                reply.plainMsg.keyEx.status = "needlogin"
+        elif msg.msgType == msg_pb2.ComMsgType.MsgTUserOp:
+            reply = _server_msg(msg_pb2.ComMsgType.MsgTUserOpRet)
+            ret = reply.plainMsg.userOpRet
+            ret.operation = msg_pb2.UserOperationType.Login
+            ret.result, ret.status = "ok", "loginok"
+            ret.users.add().userId = msg.plainMsg.userOp.user.userId
+        elif msg.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+            chat = msg.plainMsg.chatData
+            reply = _server_msg(msg_pb2.ComMsgType.MsgTChatReply)
+            reply.plainMsg.chatReply.sendId = chat.sendId
+            reply.plainMsg.chatReply.sendOk = int(time.time() * 1000)
+            reply.plainMsg.chatReply.userId = chat.fromId
+        else:
+            continue
+        await ws.send(reply.SerializeToString())
+
+
+async def run_session(chats):
+    import websockets
+
+    server = await websockets.serve(_serve_session, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = BirdTalkClient(f"ws://127.0.0.1:{port}/ws", "bench")
+    ready = asyncio.Event()
+
+    async def on_state(state, sub_state):
+        if state == ClientState.WAIT_LOGIN:
+            await client.login("id", 10003, "123456")
+        elif state == ClientState.READY:
+            ready.set()
+
+    client.set_state_callback(on_state)
+    subscriber = client.add_msg_subscriber(chats * 2)
+    started = time.perf_counter()
+    task = asyncio.create_task(client.start())
+    try:
+        await asyncio.wait_for(ready.wait(), 10)
+        handshake = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(chats):
+            await client.send_chat(10001, f"bench message {i}")
+        acked = 0
+        while acked < chats:
+            msg = await asyncio.wait_for(subscriber.get(), 10)
+            if msg is not None and msg.msgType == msg_pb2.ComMsgType.MsgTChatReply:
+                acked += 1
+        chatting = time.perf_counter() - started
+    finally:
+        client.stop()
+        await task
+        server.close()
+        await server.wait_closed()
+    return handshake * 1000, chatting / chats * 1000
+
+
+def bench_session(results, select):
+    names = ("session_handshake_ms", "session_chat_ack_ms")
+    if not any(select(name) for name in names):
+        return
+    try:
+        import websockets   # noqa: F401
+    except ImportError:
+        print("websockets is not installed, skipping session benchmarks")
+        return
+    cwd = os.getcwd()
+    samples = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)   # 客户端会在当前目录写秘钥文件
+        try:
+            with quiet():
+                for _ in range(5):
+                    samples.append(asyncio.run(run_session(200)))
+        finally:
+            os.chdir(cwd)
+    for index, name in enumerate(names):
+        if select(name):
+            results[name] = statistics.median(sample[index] for sample in samples)
+            report(name, results[name])
+
+
+##################################################################
+def run(results, select, name, func):
+    if select(name):
+        results[name] = per_op_us(func)
+        report(name, results[name])
+
+
+def report(name, value):
+    print(f"{name:32s} {value:12.3f}", flush=True)
+
+
+def load_baseline():
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def save_baseline(data):
+    with open(BASELINE, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+SUITES = (bench_crypto, bench_codec, bench_dispatch, bench_session)
+# 允许的变慢比例至少是基线各轮的中位数绝对偏差（相对于中位数）的这么多倍
+SPREAD_FACTOR = 3
+# 检查时超出阈值的项最多重跑的次数
+RETRIES = 3
+
+
+def run_all(select):
+    results = {}
+    for suite in SUITES:
+        suite(results, select)
+    return results
+
+
+def find_regressions(results, stored, spreads, threshold):
+    # 每一项允许的变慢比例：至少 threshold，抖动大的项按基线时测到的离散程度放宽
+    failed = {}
+    for name, value in results.items():
+        base = stored.get(name)
+        if base is None:
+            continue
+        limit = max(threshold, SPREAD_FACTOR * spreads.get(name, 0.0))
+        if value > base * (1 + limit):
+            failed[name] = (value, base, limit)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run SDK benchmarks and compare with the stored baseline")
+    parser.add_argument("-k", dest="keyword", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--update", action="store_true", help="store the median of several runs as the new baseline")
+    parser.add_argument("--rounds", type=int, default=5, help="runs used by --update for the baseline and its spread")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fail when slower than baseline * (1 + threshold); noisier benchmarks get more room")
+    args = parser.parse_args()
+
+    def select(name):
+        return args.keyword in name
+
+    baseline = load_baseline()
+    stored = baseline.setdefault("bench", {})
+    spreads = baseline.setdefault("bench_spread", {})
+
+    if args.update:
+        rounds = [run_all(select) for _ in range(max(1, args.rounds))]
+        for name in rounds[0]:
+            values = [result[name] for result in rounds]
+            median = statistics.median(values)
+            stored[name] = round(median, 3)
+            # 中位数绝对偏差，不受偶尔一轮特别慢的影响
+            spreads[name] = round(statistics.median(abs(v - median) for v in values) / median, 3)
+        save_baseline(baseline)
+        print(f"baseline written to {BASELINE}")
+        return 0
+
+    results = run_all(select)
+    failed = find_regressions(results, stored, spreads, args.threshold)
+    for _ in range(RETRIES):
+        if not failed:
+            break
+        # 变慢的项再跑几次取最好的结果，偶然的抖动不算回退
+        print(f"re-running {len(failed)} slow benchmark(s)")
+        for name, value in run_all(lambda name: name in failed).items():
+            results[name] = min(results[name], value)
+        failed = find_regressions({name: results[name] for name in failed}, stored, spreads, args.threshold)
+    if failed:
+        print("regressions:")
+        for name, (value, base, limit) in failed.items():
+            print(f"  {name}: {value:.3f} vs baseline {base:.3f} ({value / base - 1:+.0%}, allowed {limit:+.0%})")
+        return 1
+    print("no regressions" if stored else "no baseline yet, run with --update")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
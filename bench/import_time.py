@@ -0,0 +1,88 @@
+'''
+import 耗时的基准测试，和 bench/baseline.json 里的预算比较，超出预算时返回非 0
+python bench/import_time.py            # 检查
+python bench/import_time.py --update   # 用本次结果（乘以余量）更新预算
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# 语句 -> 执行之后不应该被加载的重量级模块
+CASES = {
+    "import birdtalk_sdk": ["asyncio", "websockets", "cryptography", "google.protobuf"],
+    "from birdtalk_sdk import BirdTalkClient": ["websockets", "cryptography", "google.protobuf"],
+}
+
+_PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+{stmt}
+elapsed = (time.perf_counter() - t) * 1000
+print(json.dumps({{"ms": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def measure(stmt, heavy, runs):
+    times = []
+    loaded = []
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", _PROBE.format(stmt=stmt, heavy=heavy)],
+                             capture_output=True, text=True, check=True, env=env, cwd=ROOT)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(result["ms"])
+        loaded = result["loaded"]
+    return statistics.median(times), loaded
+
+
+def load_baseline():
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def save_baseline(data):
+    with open(BASELINE, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check import time against the tracked budget")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--update", action="store_true", help="write new budgets from this run")
+    parser.add_argument("--headroom", type=float, default=2.0, help="budget = median * headroom")
+    args = parser.parse_args()
+
+    baseline = load_baseline()
+    budgets = baseline.setdefault("import_time_ms", {})
+    failed = False
+    for stmt, heavy in CASES.items():
+        ms, loaded = measure(stmt, heavy, args.runs)
+        budget = budgets.get(stmt)
+        status = "ok"
+        if loaded:
+            status = f"FAIL (loaded {', '.join(loaded)})"
+            failed = True
+        elif budget is not None and ms > budget:
+            status = f"FAIL (budget {budget:.1f} ms)"
+            failed = True
+        print(f"{stmt:45s} {ms:8.2f} ms  {status}")
+        if args.update:
+            budgets[stmt] = round(ms * args.headroom, 1)
+
+    if args.update:
+        save_baseline(baseline)
+        print(f"budgets written to {BASELINE}")
+    return 1 if failed and not args.update else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,30 @@
-import logging
-from .birdtalk_client import BirdTalkClient
-from .birdtalk_client import ClientState
-import birdtalk_sdk.msg_pb2 as msg_pb2
+# 子模块和较重的依赖（websockets、cryptography、protobuf 描述符）都按需加载，
+# import birdtalk_sdk 本身没有任何副作用，也不会配置 logging
+import importlib
 
 VERSION = '1.0.0'
-logging.basicConfig(level=logging.INFO)
+
+_lazy_attrs = {
+    'BirdTalkClient': ('.birdtalk_client', 'BirdTalkClient'),
+    'ClientState': ('.birdtalk_client', 'ClientState'),
+    'ThreadedClient': ('.threaded_client', 'ThreadedClient'),
+    'SessionHost': ('.session_host', 'SessionHost'),
+    'msg_pb2': ('.msg_pb2', None),
+}
+
+__all__ = ['VERSION'] + list(_lazy_attrs)
+
+
+def __getattr__(name):
+    target = _lazy_attrs.get(name)
+    if target is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attr = target
+    module = importlib.import_module(module_name, __name__)
+    value = module if attr is None else getattr(module, attr)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,18 @@
+import importlib
+
+
+class LazyModule:
+    '''
+    模块代理，第一次访问属性的时候才真正 import
+    加载之后把模块的属性复制到自身，后续访问就是普通的属性查找，不再经过 __getattr__
+    '''
+    def __init__(self, name):
+        self._lazy_name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._lazy_name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._lazy_name}'>"
@@ -1,11 +1,24 @@
+from __future__ import annotations
 import asyncio
 import locale
 import platform
 from .ws_client import WebSocketClient
 from .crypt_helper import ECDHKeyExchange
-import birdtalk_sdk.msg_pb2 as msg_pb2
+from .rate_limiter import RateLimiter
+from .inbox import Inbox
+from .endpoints import EndpointPool
+from .dedup import MsgIdDedup
+from ._lazy import LazyModule
 import socket
 
+# protobuf 描述符池加载比较慢，第一次用到的时候再加载
+msg_pb2 = LazyModule("birdtalk_sdk.msg_pb2")
+msg_template = LazyModule("birdtalk_sdk.msg_template")
+file_transfer = LazyModule("birdtalk_sdk.file_transfer")
+profiling = LazyModule("birdtalk_sdk.profiling")
+outbox = LazyModule("birdtalk_sdk.outbox")
+conversations = LazyModule("birdtalk_sdk.conversations")
+
 import time
 
 class ClientState:
@@ -37,13 +50,33 @@ class ClientState:
 
 
 
+# 这些类型的聊天消息超过阈值时，数据通过上传通道发送，消息里只带 uuidName
+# ChatMsgType: IMAGE = 1, VOICE = 2, VIDEO = 3, FILE = 4
+SPILL_MSG_TYPES = (1, 2, 3, 4)
+# 带外数据的引用放在 MsgChat.params 里
+OOB_NAME = "oobName"
+OOB_SIZE = "oobSize"
+
+
+# 一次 start() 中最多跟随的重定向次数，避免服务端配置错误时来回跳转
+MAX_REDIRECTS = 5
+
+
 class BirdTalkClient:
     '''
+    uri: 接入点，或者接入点的列表（并发探测，连接最快的一个，连接失败时换下一个）
     name: 当前使用的秘钥的一个名字
+    inbox_size: 入站待处理消息的上限，为 0 时在读循环里逐条处理（不并发）
+    inbox_per_key: 每个会话的待处理消息上限
+    record_file: 录制收发的原始帧，可以用 python -m birdtalk_sdk.replay 回放；
+                 每次断开时刷新到磁盘，重连后继续写同一个文件，close() 时关闭
+    dedup_capacity: 按 msgId 去重时精确记住的最近消息数，为 0 时不去重，见 set_dedup
     '''
-    def __init__(self, uri, name):
-        self.uri = uri
-        self.client = WebSocketClient(uri)
+    def __init__(self, uri, name, inbox_size=1000, inbox_per_key=100, record_file=None, dedup_capacity=2048):
+        self.endpoints = EndpointPool(uri)
+        self.uri = self.endpoints.uris[0]
+        self.redirectTo = None
+        self.client = WebSocketClient(self.uri, record_file)
         self.client.set_on_connect_callback(self.on_connect)
         self.client.set_on_disconnect_callback(self.on_disconnect)
         self.client.set_on_raw_message_callback(self.on_message)
@@ -51,6 +84,24 @@ class BirdTalkClient:
         self.keyEx = ECDHKeyExchange()
         self.printName = f"key_print_{name}.txt"
         self.keyName = f"shared_key_{name}.bin"
+        self.hashCacheName = f"hash_cache_{name}.json"
+        self.outboxName = f"outbox_{name}.log"
+        self.outbox = None
+        self.conversationsName = f"conversations_{name}.json"
+        self.conversations = None
+        self.uploader = None
+        self.downloader = None
+        self.spillThreshold = 64 * 1024   # 媒体消息超过这个大小就走带外上传
+        self.searchIndex = None
+        self.dedup = MsgIdDedup(dedup_capacity) if dedup_capacity > 0 else None
+        self.dedupPending = {}       # 已经收到、还没有处理完的 msgId -> 所在的消息，处理完才交给 dedup
+        self.credentials = None      # (mode, user_id, pwd)，设置后可以流水线登录
+        self.pipelineLogin = True
+        self.pipeline = None         # 本次连接流水线登录的状态：None, "sent", "rejected"
+        self.lastMsgId = 0           # 收到的最大 msgId，重连后从这里开始同步
+        self.phaseStarted = {}
+        self.handshakeTimings = {}
+        self.profiler = None
         self.keyEx.load_key_print(self.printName)
         self.keyEx.load_shared_key(self.keyName)
         self.ws_state = ClientState.INITIAL
@@ -59,6 +110,12 @@ class BirdTalkClient:
         self.onStateChangeCallback = None
         self.onErrorCallback = None
         self.userInfo = None
+        self.rateLimiter = RateLimiter()
+        self.inbox = Inbox(self.handle_msg, inbox_size, inbox_per_key) if inbox_size > 0 else None
+        self.inlineTask = None       # inbox 为 None 时，正在读循环里处理消息的任务
+        self.msgSubscribers = []
+        self.templates = {}
+        self.lastSendId = 0
     
     def get_user_info(self)-> msg_pb2.UserInfo:
         return self.userInfo
@@ -69,17 +126,55 @@ class BirdTalkClient:
     def set_state_callback(self, callback):
         self.onStateChangeCallback = callback
 
+    # 发送限流，msg_type 为 ComMsgType；rate 为每秒条数，capacity 为允许的突发条数
+    def set_rate_limit(self, msg_type, rate, capacity=None):
+        self.rateLimiter.set_limit(msg_type, rate, capacity)
+
+    def set_connection_rate_limit(self, rate, capacity=None):
+        self.rateLimiter.set_connection_limit(rate, capacity)
+
+    def set_throttle_codes(self, codes, factor=0.5):
+        self.rateLimiter.set_throttle_codes(codes, factor)
+
+    # 设置了登录信息并且有缓存的秘钥时，重连把 hello、登录和第一次同步一次发出去，不等服务端应答
+    # 服务端不认可秘钥时回到完整流程：KEY_EXCHANGE，然后和以前一样在 WAIT_LOGIN 状态里登录
+    def set_credentials(self, mode, user_id, pwd, pipeline=True):
+        self.credentials = (mode, user_id, pwd)
+        self.pipelineLogin = pipeline
+
+    def can_pipeline_login(self):
+        return (self.pipelineLogin and self.credentials is not None
+                and self.keyEx.get_key_print() != 0 and self.keyEx.get_shared_key() is not None)
+
+    # 握手各阶段的耗时（毫秒）：connect, hello, keyex, login, ready（从开始连接到 READY），mode 为本次握手的方式
+    def get_handshake_timings(self):
+        return dict(self.handshakeTimings)
+
+    def begin_phase(self, name):
+        self.phaseStarted[name] = time.perf_counter()
+
+    def end_phase(self, name):
+        started = self.phaseStarted.pop(name, None)
+        if started is not None:
+            self.handshakeTimings[name] = (time.perf_counter() - started) * 1000
+
 
 
     # 设置状态机改变
     async def set_state(self, state, sub_state=None):
         self.client_state = state
         self.client_sub_state = sub_state
+        if state == ClientState.READY:
+            self.end_phase("ready")
+            if self.outbox is not None and self.outbox.pending:
+                # 在状态回调之前取出列表，回调里新发的消息不在其中，不会被当作待重发的消息再发一次
+                asyncio.ensure_future(self.resend_outbox(self.outbox.pending_items()))
 
         if self.onStateChangeCallback != None:
             await self.onStateChangeCallback(state, sub_state)
 
     async def on_connect(self, success):
+        self.end_phase("connect")
         if success:
             print("Connected to WebSocket successfully!")
             await self.process_with_state()
@@ -100,12 +195,173 @@ class BirdTalkClient:
     #这里处理消息
     async def on_message(self, message):
         msg = self.deserialize_protobuf(message)
-        await self.dispatch_msg(msg)
+        if self.dedup is not None and self.is_duplicate(msg):
+            return
+        self.resolve_transfer_reply(msg)
+        if self.inbox is None:
+            self.inlineTask = asyncio.current_task()
+            try:
+                await self.handle_msg(msg)
+            finally:
+                self.inlineTask = None
+        else:
+            # 队列满了这里会等待，读 socket 的循环也就暂停了
+            await self.inbox.put(self.conversation_key(msg), msg)
+
+    # 上传下载的应答直接唤醒等待的请求，不经过 inbox：请求可能就是在某个消息的处理函数里
+    # （例如状态回调）发起的，应答排在它后面就永远等不到；之后仍然交给订阅者，dispatch_msg 不再处理
+    def resolve_transfer_reply(self, msg: msg_pb2.Msg):
+        if msg.WhichOneof("message") != "plainMsg":
+            return
+        if msg.msgType == msg_pb2.ComMsgType.MsgTUploadReply and self.uploader is not None:
+            self.uploader.on_upload_reply(msg.plainMsg.uploadReply)
+        elif msg.msgType == msg_pb2.ComMsgType.MsgTDownloadReply and self.downloader is not None:
+            self.downloader.on_download_reply(msg.plainMsg.downloadReply)
+
+    # inbox_size 为 0 时消息在读循环里处理，处理函数里等待服务端的应答会让读循环永远卡住
+    def in_inline_dispatch(self) -> bool:
+        return self.inlineTask is not None and asyncio.current_task() is self.inlineTask
+
+    # 推送的消息和同步结果里重复的 msgId 只处理一次；同步结果里去掉重复的条目，结果本身仍然交给上层
+    # msgId 在 handle_msg 处理完以后才记入 dedup；stop() 时还在 inbox 里没有处理的消息会被丢掉，
+    # 它们的 msgId 也随之忘掉，重连后同步回来的时候照常处理
+    def is_duplicate(self, msg: msg_pb2.Msg) -> bool:
+        if msg.WhichOneof("message") != "plainMsg":
+            return False
+        if msg.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+            return not self.claim_msg_id(msg.plainMsg.chatData.msgId, msg)
+        if msg.msgType == msg_pb2.ComMsgType.MsgTQueryResult:
+            chats = msg.plainMsg.commonQueryRet.chatDataList
+            duplicates = [i for i, chat in enumerate(chats) if not self.claim_msg_id(chat.msgId, msg)]
+            for i in reversed(duplicates):
+                del chats[i]
+        return False
+
+    # 新的 msgId 记为处理中并返回 True；已经处理过或者正在处理返回 False
+    def claim_msg_id(self, msg_id, msg) -> bool:
+        if not msg_id:
+            return True
+        if msg_id in self.dedupPending:
+            self.dedup.stats["pending_hits"] += 1
+            return False
+        if self.dedup.has(msg_id):
+            return False
+        self.dedupPending[msg_id] = msg
+        return True
+
+    @staticmethod
+    def chat_msg_ids(msg: msg_pb2.Msg):
+        if msg.WhichOneof("message") != "plainMsg":
+            return ()
+        if msg.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+            return (msg.plainMsg.chatData.msgId,)
+        if msg.msgType == msg_pb2.ComMsgType.MsgTQueryResult:
+            return [chat.msgId for chat in msg.plainMsg.commonQueryRet.chatDataList]
+        return ()
+
+    # 处理完（包括处理出错）的记入 dedup；被取消的只是忘掉，之后再收到还会处理
+    # stop() 之后被取消的旧消息可能晚于同步结果结束，只处理自己登记的 msgId
+    def settle_msg_ids(self, msg: msg_pb2.Msg, handled):
+        if not self.dedupPending:
+            return
+        for msg_id in self.chat_msg_ids(msg):
+            if self.dedupPending.get(msg_id) is msg:
+                del self.dedupPending[msg_id]
+                if handled and self.dedup is not None:
+                    self.dedup.add(msg_id)
+
+    # 同一个会话的消息按顺序处理，不同会话可以并发；其他控制类消息都在同一个 key 里按顺序处理
+    def conversation_key(self, msg: msg_pb2.Msg):
+        if msg.WhichOneof("message") != "plainMsg":
+            return None
+        if msg.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+            return self.chat_conversation_key(msg.plainMsg.chatData)
+        if msg.msgType == msg_pb2.ComMsgType.MsgTChatReply:
+            my_id = self.userInfo.userId if self.userInfo else 0
+            reply = msg.plainMsg.chatReply
+            peer = reply.userId if reply.fromId == my_id else reply.fromId
+            return (msg_pb2.ChatType.ChatTypeP2P, peer)
+        return None
+
+    # 会话为 (chatType, 对方用户 id 或群组 id)
+    def chat_conversation_key(self, chat: msg_pb2.MsgChat):
+        if chat.chatType == msg_pb2.ChatType.ChatTypeGroup:
+            return (chat.chatType, chat.toId)
+        my_id = self.userInfo.userId if self.userInfo else 0
+        peer = chat.toId if chat.fromId == my_id else chat.fromId
+        return (chat.chatType, peer)
+
+    async def handle_msg(self, msg: msg_pb2.Msg):
+        handled = True
+        try:
+            if self.profiler is None:
+                await self.dispatch_msg(msg)
+            else:
+                await self.profiler.run(self.dispatch_msg, msg)
+            for queue in list(self.msgSubscribers):
+                await queue.put(msg)
+        except asyncio.CancelledError:
+            handled = False    # 客户端停止了，没有处理完
+            raise
+        finally:
+            self.settle_msg_ids(msg, handled)
+
+    async def messages(self, maxsize=1000):
+        '''
+        async for msg in client.messages(): 流式获取收到的消息（已经经过 dispatch_msg 处理）
+        消费得慢的时候会反压到 inbox，最终暂停读 socket
+        '''
+        queue = self.add_msg_subscriber(maxsize)
+        try:
+            while True:
+                msg = await queue.get()
+                if msg is None:   # 客户端已经停止
+                    return
+                yield msg
+        finally:
+            self.remove_msg_subscriber(queue)
+
+    # 订阅收到的消息，客户端停止的时候队列里会收到 None
+    def add_msg_subscriber(self, maxsize=1000) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize)
+        self.msgSubscribers.append(queue)
+        return queue
+
+    def remove_msg_subscriber(self, queue):
+        if queue in self.msgSubscribers:
+            self.msgSubscribers.remove(queue)
 
     async def start(self):
         self.running = True
+        tried = set()
+        redirects = 0
         try:
-            await self.client.start()
+            while self.running:
+                uri = await self.endpoints.select(tried)
+                if not self.running:
+                    break    # 探测的过程中调用了 stop()
+                if uri is None:
+                    print("Error: no endpoint is reachable")
+                    break
+                self.uri = self.client.uri = uri
+                self.redirectTo = None
+                self.client_state = ClientState.HELLO   # 每个新连接都从 hello 开始
+                self.pipeline = None
+                self.handshakeTimings = {}
+                self.phaseStarted = {}
+                self.begin_phase("connect")
+                self.begin_phase("ready")
+                self.client.reset()    # 和上面检查 running 之间没有 await，stop() 不会丢
+                if not await self.client.start():
+                    self.endpoints.mark_failed(uri)
+                    tried.add(uri)
+                    continue
+                self.endpoints.mark_ok(uri)
+                if self.redirectTo is None or redirects >= MAX_REDIRECTS:
+                    break
+                # 服务端要求重定向：只换连接，inbox、订阅者、模板等应用层状态都保留
+                redirects += 1
+                tried = set()
         except KeyboardInterrupt:
             print("Keyboard interrupt detected, exiting...")
         finally:
@@ -115,8 +371,29 @@ class BirdTalkClient:
         if self.running:
             self.client.stop()
             self.running = False
+            if self.inbox is not None:
+                self.inbox.close()
+            self.dedupPending.clear()    # inbox 里丢掉的消息没有处理过，不算见过
+            if self.searchIndex is not None:
+                self.searchIndex.flush()
+            if self.outbox is not None:
+                self.outbox.flush()
+            if self.uploader is not None:
+                self.uploader.cache.save()
+            if self.conversations is not None:
+                self.conversations.save()
+            for queue in self.msgSubscribers:
+                try:
+                    queue.put_nowait(None)
+                except asyncio.QueueFull:
+                    pass
             print("BirdTalkClient stopped.")
 
+    # 最终关闭：stop() 只结束当前这次连接，之后还可以再 start() 重连，录制文件在这里才关闭
+    def close(self):
+        self.stop()
+        self.client.stop_recording()
+
     async def run_forever(self):
         try:
             while self.running:
@@ -128,8 +405,17 @@ class BirdTalkClient:
 
     async def send(self, message):
         if isinstance(message, msg_pb2.Msg):
+                if message.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+                    if not message.plainMsg.chatData.sendId:
+                        # 发件箱和服务端去重都按 sendId，自己构造的消息没有填时在这里分配
+                        message.plainMsg.chatData.sendId = self.next_send_id()
+                    message = await self.spill_chat_data(message)
+                # 超过限速的时候在这里异步等待，而不是失败
+                await self.rateLimiter.acquire(message.msgType)
             # Serialize the protobuf message to bytes
                 serialized_message = message.SerializeToString()
+                if self.outbox is not None and message.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+                    await self.outbox.put(message.plainMsg.chatData.sendId, serialized_message)
                 #print(f"Sent protobuf message of type {type(message)}")
                 #print(f"formatted message of type type(serialized_message)")
                 await self.client.send_message(serialized_message)
@@ -140,12 +426,50 @@ class BirdTalkClient:
             print(f"count not send message: {message}")
             #await self.websocket.send(message)
 
+    # 已经编码好的消息（例如模板生成的）直接发送，msg_type 用于限流
+    async def send_encoded(self, data: bytes, msg_type):
+        await self.rateLimiter.acquire(msg_type)
+        await self.client.send_message(data)
+
+    # 毫秒时间戳 * 1000 + 序号，保证单调递增
+    def next_send_id(self) -> int:
+        send_id = max(self.lastSendId + 1, int(time.time() * 1000) * 1000)
+        self.lastSendId = send_id
+        return send_id
+
+    # 高频消息的预编码模板，按当前登录的用户缓存
+    def get_template(self, kind, *args):
+        from_id = self.userInfo.userId if self.userInfo else 0
+        key = (kind, from_id) + args
+        tpl = self.templates.get(key)
+        if tpl is None:
+            if kind == "chat":
+                tpl = msg_template.chat_template(from_id, *args)
+            elif kind == "reply":
+                tpl = msg_template.chat_reply_template(from_id)
+            elif kind == "heartbeat":
+                tpl = msg_template.heartbeat_template(from_id)
+            else:
+                raise ValueError(f"unknown template kind: {kind}")
+            self.templates[key] = tpl
+        return tpl
+
 #################################################################
     # 状态机，根据当前的状态决定如何操作
     async def process_with_state(self):
         if self.client_state == ClientState.HELLO:
             hello = self.create_hello()
+            self.begin_phase("hello")
             await self.send(hello)
+            if self.can_pipeline_login():
+                # 乐观地认为服务端认可缓存的秘钥，不等 hello 的应答，登录和第一次同步一起发出去
+                self.pipeline = "sent"
+                self.handshakeTimings["mode"] = "pipelined"
+                self.begin_phase("login")
+                await self.send(self.create_login(*self.credentials))
+                await self.send(self.create_sync_query(self.lastMsgId))
+            else:
+                self.handshakeTimings["mode"] = "full"
             return
         
         
@@ -169,22 +493,103 @@ class BirdTalkClient:
         elif msg.msgType == msg_pb2.ComMsgType.MsgTUserOpRet: # 用户操作的应答
             await self.on_user_op_ret(msg)
             return
+        elif msg.msgType in (msg_pb2.ComMsgType.MsgTUploadReply, msg_pb2.ComMsgType.MsgTDownloadReply):
+            return   # 已经在 on_message 里由 resolve_transfer_reply 处理，这里再处理会把迟到的应答交给后面的请求
+        elif msg.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+            await self.on_chat_msg(msg)
+            return
+        elif msg.msgType == msg_pb2.ComMsgType.MsgTChatReply:
+            await self.on_chat_reply(msg)
+            return
+        elif msg.msgType == msg_pb2.ComMsgType.MsgTQueryResult:
+            await self.on_query_result(msg)
+            return
 
 
     async def on_error(self, msg: msg_pb2.Msg):
         err = msg.plainMsg.errorMsg
+        self.rateLimiter.on_error_code(err.code)
+        if err.code == msg_pb2.ErrorMsgType.ErrTRedirect:
+            await self.redirect(err.params.get("redirect") or err.detail)
         if self.onErrorCallback != None:
             await self.onErrorCallback("test")
         
 
+    async def on_chat_msg(self, msg: msg_pb2.Msg):
+        if msg.WhichOneof("message") != "plainMsg":
+            return
+        chat = msg.plainMsg.chatData
+        self.lastMsgId = max(self.lastMsgId, chat.msgId)
+        if self.searchIndex is not None:
+            self.searchIndex.on_chat(chat, self.chat_conversation_key(chat))
+        if self.conversations is not None:
+            self.update_conversation(chat)
+
+    async def on_chat_reply(self, msg: msg_pb2.Msg):
+        if msg.WhichOneof("message") != "plainMsg":
+            return
+        reply = msg.plainMsg.chatReply
+        if self.outbox is not None and reply.sendOk:
+            self.outbox.done(reply.sendId)
+        if self.conversations is not None and reply.readOk:
+            my_id = self.userInfo.userId if self.userInfo else 0
+            if reply.fromId == my_id:   # 自己在其他设备上读了
+                self.conversations.mark_read((msg_pb2.ChatType.ChatTypeP2P, reply.userId), reply.msgId)
+            else:
+                self.conversations.on_peer_read((msg_pb2.ChatType.ChatTypeP2P, reply.fromId), reply.msgId)
+
+    # 删除和秘钥协商消息不算会话里的活动
+    def update_conversation(self, chat: msg_pb2.MsgChat):
+        if chat.msgType in (msg_pb2.ChatMsgType.DELETE, msg_pb2.ChatMsgType.KEY):
+            return
+        my_id = self.userInfo.userId if self.userInfo else 0
+        self.conversations.on_incoming(self.chat_conversation_key(chat), chat.msgId, chat.fromId,
+                                       chat.tm, chat.msgType, chat.data, my_id)
+
+    # 同步查询的结果，聊天数据也加入本地索引
+    async def on_query_result(self, msg: msg_pb2.Msg):
+        if msg.WhichOneof("message") != "plainMsg":
+            return
+        for chat in msg.plainMsg.commonQueryRet.chatDataList:
+            self.lastMsgId = max(self.lastMsgId, chat.msgId)
+            if self.searchIndex is not None:
+                self.searchIndex.on_chat(chat, self.chat_conversation_key(chat))
+            if self.conversations is not None:
+                self.update_conversation(chat)
+
+    # 断开当前连接，start() 里会连接到 target（ip:port 或者完整的 uri）
+    async def redirect(self, target):
+        if not target:
+            return
+        uri = self.endpoints.redirect(self.uri, target)
+        if uri == self.uri:
+            return
+        print(f"redirect from {self.uri} to {uri}")
+        self.redirectTo = uri
+        self.client.stop()
+
     async def on_hello(self, msg: msg_pb2.Msg):
         hello = msg.plainMsg.hello
+        self.end_phase("hello")
+        if hello.params.get("redirect"):
+            await self.redirect(hello.params["redirect"])
+            return
         if hello.stage == "waitlogin":   # 执行密钥交换
+            if self.pipeline == "sent":
+                # 服务端不认可缓存的秘钥，流水线发出的登录会失败，回到完整的流程
+                print("pipelined login rejected, fall back to key exchange")
+                self.pipeline = "rejected"
+                self.handshakeTimings["mode"] = "fallback"
+                self.phaseStarted.pop("login", None)
             await self.set_state(ClientState.KEY_EXCHANGE)
+            self.begin_phase("keyex")
             msg = self.create_keyex1()
             await self.send(msg)
 
         elif hello.stage == "needlogin": # 注册或者登录
+            if self.pipeline == "sent":
+                await self.set_state(ClientState.LOGINING)   # 登录请求已经在路上了
+                return
             await self.set_state(ClientState.WAIT_LOGIN)
             print("need login first")
 
@@ -217,6 +622,8 @@ class BirdTalkClient:
             await self.send(data)
         
         elif keyex.stage == 4:  # 交换秘钥之后也需要登录，或者注册
+            self.end_phase("keyex")
+            self.pipeline = None   # 被拒绝的流水线请求的应答都已经在这之前到达了
             if keyex.status == "waitdata":
                 await self.set_state(ClientState.READY, ClientState.KEY_EXCHANGE)
                 print("user login ok")
@@ -228,12 +635,18 @@ class BirdTalkClient:
         msgRet = msg.plainMsg.userOpRet
         if msgRet.operation == msg_pb2.UserOperationType.Login:   # 登录返回
             if msgRet.result != "ok":
+                if self.pipeline == "rejected":
+                    self.pipeline = None   # 被拒绝的流水线登录的应答，完整流程里会重新登录
+                    return
                 await self.set_state(ClientState.WAIT_LOGIN, ClientState.LOGIN_FAIL)
                 return
+            self.end_phase("login")
             #print(msgRet.users[0])
             self.userInfo = msgRet.users[0]
             
             if msgRet.status == "loginok":
+                if self.client_state == ClientState.READY:
+                    return   # 已经通过秘钥指纹进入 READY 了（流水线登录时两个应答都会到）
                 await self.set_state(ClientState.READY, ClientState.LOGIN_OK)
             elif msgRet.status == "waitcode":
                 await self.set_state(ClientState.LOGINING, ClientState.WAIT_CODE)
@@ -345,8 +758,7 @@ class BirdTalkClient:
     def get_current_timestamp(self)-> int:
         return int(time.time())
 
-    async def login(self, mode, user_id, pwd):
-        print("发送登录消息")
+    def create_login(self, mode, user_id, pwd) -> msg_pb2.Msg:
 
         # 创建 UserInfo 对象
         user_info = msg_pb2.UserInfo()
@@ -374,6 +786,238 @@ class BirdTalkClient:
         msg.version = 1
         msg.plainMsg.CopyFrom(plain_msg)
         msg.tm = self.get_current_timestamp()
+        return msg
 
-        await self.send(msg)
+    async def login(self, mode, user_id, pwd):
+        print("发送登录消息")
+        self.begin_phase("login")
+        await self.send(self.create_login(mode, user_id, pwd))
+
+    # 同步 little_id 之后的私聊消息
+    def create_sync_query(self, little_id=0) -> msg_pb2.Msg:
+        query = msg_pb2.MsgQuery()
+        if self.userInfo is not None:
+            query.userId = self.userInfo.userId
+        elif self.credentials is not None and self.credentials[0] == "id":
+            query.userId = int(self.credentials[1])
+        query.littleId = little_id
+        query.synType = msg_pb2.SynType.SynTypeForward
+        query.chatType = msg_pb2.ChatType.ChatTypeP2P
+        query.queryType = msg_pb2.QueryDataType.QueryDataTypeChatData
+        query.tm = self.get_current_timestamp()
+
+        msg = msg_pb2.Msg()
+        msg.msgType = msg_pb2.ComMsgType.MsgTQuery
+        msg.version = 1
+        msg.tm = query.tm
+        msg.plainMsg.commonQuery.CopyFrom(query)
+        return msg
+
+    # 发送聊天消息，返回 sendId；msg_type 为 ChatMsgType，chat_type 为 ChatType
+    async def send_chat(self, to_id, data, msg_type=None, chat_type=None) -> int:
+        if msg_type is None:
+            msg_type = msg_pb2.ChatMsgType.TEXT
+        if chat_type is None:
+            chat_type = msg_pb2.ChatType.ChatTypeP2P
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        if len(data) > self.spillThreshold and msg_type in SPILL_MSG_TYPES:
+            # 大的媒体消息不走模板，由 send 上传数据后只发送引用
+            return await self.send_chat_msg(to_id, data, msg_type, chat_type)
+
+        tpl = self.get_template("chat", chat_type, msg_type)
+        send_id = self.next_send_id()
+        tm_ms = int(time.time() * 1000)
+        payload = tpl.render(tm=tm_ms // 1000, chat_tm=tm_ms, send_id=send_id, to_id=to_id, data=data)
+        if self.outbox is not None:
+            await self.outbox.put(send_id, payload)   # 先落盘再发送
+        await self.send_encoded(payload, tpl.msg_type)
+        if self.conversations is not None:
+            self.conversations.on_outgoing((chat_type, to_id), tm_ms, data, msg_type,
+                                         self.userInfo.userId if self.userInfo else 0)
+        return send_id
+
+    # 发送送达/已读回执，to_id 是原消息的发送者
+    async def send_chat_receipt(self, msg_id, send_id, to_id, read=False):
+        tpl = self.get_template("reply")
+        tm_ms = int(time.time() * 1000)
+        payload = tpl.render(tm=tm_ms // 1000, msg_id=msg_id, send_id=send_id, user_id=to_id,
+                             recv_ok=tm_ms, read_ok=tm_ms if read else 0)
+        await self.send_encoded(payload, tpl.msg_type)
+        if read and self.conversations is not None:
+            self.conversations.mark_read((msg_pb2.ChatType.ChatTypeP2P, to_id), msg_id)
+
+    async def send_heartbeat(self):
+        tpl = self.get_template("heartbeat")
+        tm = self.get_current_timestamp()
+        await self.send_encoded(tpl.render(tm=tm, hb_tm=tm), tpl.msg_type)
+
+    def get_uploader(self):
+        if self.uploader is None:
+            cache = file_transfer.HashCache(self.hashCacheName)
+            self.uploader = file_transfer.FileUploader(self, cache)
+        return self.uploader
+
+    # 上传文件，返回服务端的 uuidName；服务端已有相同哈希的文件时不会再上传数据
+    async def upload_file(self, path, file_type="", group_id=0) -> str:
+        return await self.get_uploader().upload_file(path, file_type, group_id)
+
+    def get_downloader(self):
+        if self.downloader is None:
+            self.downloader = file_transfer.FileDownloader(self)
+        return self.downloader
+
+    # 媒体消息超过这个字节数就自动走带外上传，0 表示不启用
+    def set_spill_threshold(self, size):
+        self.spillThreshold = size if size > 0 else float("inf")
+
+    # capacity 为精确记住的最近 msgId 个数，为 0 时关闭去重；filter_capacity > 0 时更早的 msgId 放进误判率为 fpp 的布隆过滤器
+    def set_dedup(self, capacity, filter_capacity=0, fpp=1e-6):
+        self.dedup = MsgIdDedup(capacity, filter_capacity, fpp) if capacity > 0 else None
+        self.dedupPending.clear()
+
+    def get_dedup_metrics(self):
+        return self.dedup.get_metrics() if self.dedup is not None else {}
+
+    # 运行时诊断：按 ComMsgType 统计 dispatch_msg 的耗时，超过 slow_ms 的通过 logging 警告
+    def enable_profiling(self, sample_every=1, slow_ms=100.0):
+        self.profiler = profiling.HandlerProfiler(sample_every, slow_ms)
+
+    def disable_profiling(self):
+        self.profiler = None
+
+    def get_profile(self):
+        return self.profiler.report() if self.profiler is not None else {}
+
+    # 各个缓存、队列、等待中的 future 占用的内存，以及 tracemalloc 统计的 SDK 各文件的分配
+    def memory_report(self, limit=10):
+        return profiling.memory_report(self, limit)
+
+    # kill -USR1 <pid>：第一次打开统计，第二次输出报告并关闭
+    def install_profiling_signal(self, signum=None):
+        profiling.install_signal_handler(self, signum)
+
+    # 打开持久化发件箱：聊天消息发送前先落盘，服务端确认之前每次进入 READY 都会重发
+    def enable_outbox(self, filename=None):
+        if self.outbox is None:
+            self.outbox = outbox.Outbox(filename or self.outboxName)
+
+    def get_pending_sends(self):
+        return self.outbox.pending_items() if self.outbox is not None else []
+
+    # 重发没有确认的消息，sendId 不变，服务端据此去重；items 默认为当前所有待确认的消息
+    async def resend_outbox(self, items=None):
+        if items is None:
+            items = self.outbox.pending_items()
+        for send_id, data in items:
+            if self.client_state != ClientState.READY:
+                return
+            if send_id not in self.outbox.pending:
+                continue   # 重发的过程中已经确认了
+            self.outbox.stats["resent"] += 1
+            await self.send_encoded(data, msg_pb2.ComMsgType.MsgTChatMsg)
+
+    # 最近会话列表（conversations.ConversationIndex），由收发的消息增量维护，客户端停止时保存
+    def enable_conversations(self, filename=None):
+        if self.conversations is None:
+            self.conversations = conversations.ConversationIndex(filename or self.conversationsName)
+        return self.conversations
+
+    # 本地全文索引（search_index.SearchIndex），收到的和同步到的文本消息都会加入索引
+    def set_search_index(self, index):
+        self.searchIndex = index
+
+    # 不用模板，完整地构造一个聊天消息发送（会经过 send 里的带外处理）
+    async def send_chat_msg(self, to_id, data, msg_type, chat_type) -> int:
+        chat = msg_pb2.MsgChat()
+        chat.fromId = self.userInfo.userId if self.userInfo else 0
+        chat.toId = to_id
+        chat.tm = int(time.time() * 1000)
+        chat.sendId = self.next_send_id()
+        chat.msgType = msg_type
+        chat.chatType = chat_type
+        chat.data = data
 
+        msg = msg_pb2.Msg()
+        msg.msgType = msg_pb2.ComMsgType.MsgTChatMsg
+        msg.version = 1
+        msg.plainMsg.chatData.CopyFrom(chat)
+        msg.tm = self.get_current_timestamp()
+        await self.send(msg)
+        if self.conversations is not None:
+            self.conversations.on_outgoing((chat_type, to_id), chat.tm, data, msg_type, chat.fromId)
+        return chat.sendId
+
+    # 大的媒体数据先分块上传，消息里只保留引用，避免一个大帧堵住后面所有的消息
+    # 返回实际要发送的消息：需要带外发送时是一个副本，调用方的消息不会被修改
+    async def spill_chat_data(self, msg: msg_pb2.Msg) -> msg_pb2.Msg:
+        chat = msg.plainMsg.chatData
+        if chat.msgType not in SPILL_MSG_TYPES or len(chat.data) <= self.spillThreshold:
+            return msg
+        file_name = f"{chat.fromId}_{chat.sendId}"
+        uuid_name = await self.get_uploader().upload_bytes(chat.data, file_name, str(chat.msgType))
+        spilled = msg_pb2.Msg()
+        spilled.CopyFrom(msg)
+        spilled_chat = spilled.plainMsg.chatData
+        spilled_chat.data = b""
+        spilled_chat.params[OOB_NAME] = uuid_name
+        spilled_chat.params[OOB_SIZE] = str(len(chat.data))
+        return spilled
+
+    def is_chat_data_spilled(self, chat: msg_pb2.MsgChat) -> bool:
+        return OOB_NAME in chat.params
+
+    # 获取聊天消息的内容；带外发送的内容在第一次调用时才下载
+    async def load_chat_data(self, chat: msg_pb2.MsgChat) -> bytes:
+        if OOB_NAME not in chat.params:
+            return chat.data
+        return await self.get_downloader().download(chat.params[OOB_NAME])
+
+
+###############################################################
+def test_resync_after_stop():
+    # inbox 里还没有处理的消息在 stop() 时被丢掉，重连后同步回来的同样的 msgId 必须再处理
+    async def run():
+        client = BirdTalkClient("ws://127.0.0.1:1/ws", "test_resync")
+        handled = []
+        blocked = asyncio.Event()
+
+        async def dispatch(msg):
+            if msg.msgType == msg_pb2.ComMsgType.MsgTChatMsg:
+                await blocked.wait()
+                handled.append(msg.plainMsg.chatData.msgId)
+            elif msg.msgType == msg_pb2.ComMsgType.MsgTQueryResult:
+                handled.extend(chat.msgId for chat in msg.plainMsg.commonQueryRet.chatDataList)
+
+        client.dispatch_msg = dispatch
+        client.running = True
+        ids = [7000000000000001 + i for i in range(5)]
+        for msg_id in ids:
+            msg = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTChatMsg)
+            msg.plainMsg.chatData.msgId = msg_id
+            await client.on_message(msg.SerializeToString())
+        await asyncio.sleep(0)
+        client.stop()
+
+        blocked.set()
+        result = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTQueryResult)
+        for msg_id in ids + ids[:1]:      # 同一个结果里重复的条目只处理一次
+            result.plainMsg.commonQueryRet.chatDataList.add().msgId = msg_id
+        await client.on_message(result.SerializeToString())
+        await client.inbox.join()
+        assert handled == ids, handled
+
+        # 处理过的再收到就是重复的
+        again = msg_pb2.Msg(msgType=msg_pb2.ComMsgType.MsgTChatMsg)
+        again.plainMsg.chatData.msgId = ids[0]
+        await client.on_message(again.SerializeToString())
+        await client.inbox.join()
+        assert handled == ids, handled
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_resync_after_stop()
+    print("ok")
@@ -0,0 +1,299 @@
+'''
+最近会话列表：每个会话（单聊的对方或者群组）的最后一条消息、未读数和已读位置，按最后活动时间排序
+
+    convs = client.enable_conversations()
+    convs.add_listener(lambda conv, reason: print(reason, conv))
+    for conv in convs.get_conversations(limit=20): ...
+    convs.mark_read((ChatType.ChatTypeP2P, 10001))
+
+由 BirdTalkClient 增量维护：收到的 MsgChat、同步结果、MsgChatReply.readOk 和发出的消息；
+不需要扫描历史消息。保存为一个 json 文件，写入方式和 HashCache 一样
+'''
+import bisect
+import json
+import os
+
+PREVIEW_CHARS = 64
+MAX_UNREAD_IDS = 1000    # 未读的 msgId 最多记这么多，超过的只计数
+
+
+class SortedKeyList:
+    '''
+    分桶的有序列表：每个桶是一个有序的 list，另外记录每个桶的最大值
+    插入和删除先二分找到桶，再在桶内二分，桶的大小有上限，移动元素的代价是常数级的
+    '''
+    LOAD = 256
+
+    def __init__(self):
+        self.buckets = []
+        self.maxes = []
+        self.size = 0
+
+    def add(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+        else:
+            i = bisect.bisect_left(self.maxes, key)
+            if i == len(self.maxes):
+                i -= 1
+                self.buckets[i].append(key)
+                self.maxes[i] = key
+            else:
+                bisect.insort(self.buckets[i], key)
+            bucket = self.buckets[i]
+            if len(bucket) > 2 * self.LOAD:
+                half = bucket[self.LOAD:]
+                del bucket[self.LOAD:]
+                self.buckets.insert(i + 1, half)
+                self.maxes[i] = bucket[-1]
+                self.maxes.insert(i + 1, half[-1])
+        self.size += 1
+
+    def remove(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            raise KeyError(key)
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, key)
+        if j == len(bucket) or bucket[j] != key:
+            raise KeyError(key)
+        del bucket[j]
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+        self.size -= 1
+
+    def slice(self, offset, limit):
+        result = []
+        for bucket in self.buckets:
+            if offset >= len(bucket):
+                offset -= len(bucket)
+                continue
+            result.extend(bucket[offset:offset + limit - len(result)])
+            offset = 0
+            if len(result) >= limit:
+                break
+        return result
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket
+
+    def __len__(self):
+        return self.size
+
+
+class Conversation:
+    __slots__ = ("key", "last_tm", "last_msg_id", "last_from", "last_type", "preview",
+                 "unread_ids", "unread_extra", "read_id", "peer_read_id")
+
+    def __init__(self, key):
+        self.key = key               # (chatType, 对方用户 id 或群组 id)
+        self.last_tm = 0
+        self.last_msg_id = 0
+        self.last_from = 0
+        self.last_type = 0
+        self.preview = ""
+        self.unread_ids = []         # 自己还没读的消息，升序
+        self.unread_extra = 0        # unread_ids 装不下的部分
+        self.read_id = 0             # 自己已读到的位置
+        self.peer_read_id = 0        # 对方已读到的位置（我发出的消息）
+
+    def unread(self):
+        return len(self.unread_ids) + self.unread_extra
+
+    def to_dict(self):
+        return {
+            "chatType": self.key[0], "peerId": self.key[1],
+            "lastTm": self.last_tm, "lastMsgId": self.last_msg_id, "lastFrom": self.last_from,
+            "lastType": self.last_type, "preview": self.preview, "unread": self.unread(),
+            "readId": self.read_id, "peerReadId": self.peer_read_id,
+        }
+
+    def to_row(self):
+        return [self.key[0], self.key[1], self.last_tm, self.last_msg_id, self.last_from, self.last_type,
+                self.preview, self.unread_ids, self.unread_extra, self.read_id, self.peer_read_id]
+
+    @classmethod
+    def from_row(cls, row):
+        conv = cls((row[0], row[1]))
+        (conv.last_tm, conv.last_msg_id, conv.last_from, conv.last_type, conv.preview,
+         conv.unread_ids, conv.unread_extra, conv.read_id, conv.peer_read_id) = row[2:]
+        return conv
+
+
+def make_preview(data, msg_type):
+    if msg_type != 0:   # 非文本消息只记类型
+        return ""
+    if isinstance(data, bytes):
+        data = data[:PREVIEW_CHARS * 4].decode('utf-8', errors='ignore')
+    return data[:PREVIEW_CHARS]
+
+
+class ConversationIndex:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.convs = {}                 # key -> Conversation
+        self.order = SortedKeyList()    # (-last_tm, chatType, peer)，最近活动的在前面
+        self.listeners = []
+        self.dirty = False
+        if filename:
+            self.load()
+
+    ##################################################################
+    # 持久化
+    def load(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            return
+        except (IOError, ValueError) as e:
+            print(f"Error: cannot load conversations '{self.filename}': {e}")
+            return
+        self.convs.clear()
+        self.order = SortedKeyList()
+        for row in rows:
+            conv = Conversation.from_row(row)
+            self.convs[conv.key] = conv
+            self.order.add(self._order_key(conv))
+
+    def save(self):
+        if not self.filename or not self.dirty:
+            return
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump([self.convs[(k[1], k[2])].to_row() for k in self.order], f,
+                      ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, self.filename)
+        self.dirty = False
+
+    ##################################################################
+    # 查询
+    def get(self, key):
+        conv = self.convs.get(tuple(key))
+        return conv.to_dict() if conv is not None else None
+
+    def get_conversations(self, offset=0, limit=50):
+        return [self.convs[(k[1], k[2])].to_dict() for k in self.order.slice(offset, limit)]
+
+    def total_unread(self):
+        return sum(conv.unread() for conv in self.convs.values())
+
+    def __len__(self):
+        return len(self.convs)
+
+    # callback(conversation_dict, reason)，reason 为 "message", "sent", "read", "peer_read", "removed"
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    ##################################################################
+    # 更新
+    @staticmethod
+    def _order_key(conv):
+        return (-conv.last_tm, conv.key[0], conv.key[1])
+
+    def _get_or_create(self, key):
+        conv = self.convs.get(key)
+        if conv is None:
+            conv = Conversation(key)
+            self.convs[key] = conv
+            self.order.add(self._order_key(conv))
+        return conv
+
+    def _touch(self, conv, tm, msg_id, from_id, msg_type, preview):
+        if tm < conv.last_tm:
+            return False     # 同步到的旧消息不改变最后一条
+        self.order.remove(self._order_key(conv))
+        conv.last_tm = tm
+        conv.last_msg_id = msg_id
+        conv.last_from = from_id
+        conv.last_type = msg_type
+        conv.preview = preview
+        self.order.add(self._order_key(conv))
+        return True
+
+    def _notify(self, conv, reason):
+        self.dirty = True
+        if self.listeners:
+            info = conv.to_dict() if conv is not None else None
+            for callback in list(self.listeners):
+                try:
+                    callback(info, reason)
+                except Exception as e:
+                    print(f"Error in conversation listener: {e!r}")
+
+    def on_incoming(self, key, msg_id, from_id, tm, msg_type, data, my_id):
+        conv = self._get_or_create(key)
+        changed = self._touch(conv, tm, msg_id, from_id, msg_type, make_preview(data, msg_type))
+        if from_id != my_id and msg_id > conv.read_id:
+            ids = conv.unread_ids
+            i = bisect.bisect_left(ids, msg_id)
+            if i == len(ids) or ids[i] != msg_id:
+                ids.insert(i, msg_id)
+                if len(ids) > MAX_UNREAD_IDS:
+                    ids.pop(0)
+                    conv.unread_extra += 1
+                changed = True
+        elif from_id == my_id:
+            # 自己（可能是其他设备）发的消息，说明之前的都看过了
+            changed = self._mark_read(conv, msg_id) or changed
+        if changed:
+            self._notify(conv, "message")
+
+    def on_outgoing(self, key, tm, data, msg_type, from_id):
+        conv = self._get_or_create(key)
+        self._touch(conv, tm, 0, from_id, msg_type, make_preview(data, msg_type))
+        self._clear_unread(conv)     # 在会话里发消息，说明之前的都看过了
+        self._notify(conv, "sent")
+
+    def _clear_unread(self, conv):
+        if conv.unread_ids:
+            conv.read_id = max(conv.read_id, conv.unread_ids[-1])
+        conv.read_id = max(conv.read_id, conv.last_msg_id)
+        conv.unread_ids.clear()
+        conv.unread_extra = 0
+
+    def _mark_read(self, conv, msg_id):
+        if msg_id <= conv.read_id:
+            return False
+        conv.read_id = msg_id
+        ids = conv.unread_ids
+        if conv.unread_extra and (not ids or msg_id >= ids[0]):
+            conv.unread_extra = 0    # 超出上限没有记下来的都比 ids[0] 早
+        del ids[:bisect.bisect_right(ids, msg_id)]
+        return True
+
+    # msg_id 为 None 时标记整个会话已读
+    def mark_read(self, key, msg_id=None):
+        conv = self.convs.get(tuple(key))
+        if conv is None:
+            return
+        if msg_id is None:
+            if not conv.unread():
+                return
+            self._clear_unread(conv)
+        elif not self._mark_read(conv, msg_id):
+            return
+        self._notify(conv, "read")
+
+    def on_peer_read(self, key, msg_id):
+        conv = self.convs.get(key)
+        if conv is None or msg_id <= conv.peer_read_id:
+            return
+        conv.peer_read_id = msg_id
+        self._notify(conv, "peer_read")
+
+    def remove(self, key):
+        conv = self.convs.pop(tuple(key), None)
+        if conv is not None:
+            self.order.remove(self._order_key(conv))
+            self.dirty = True
+            self._notify(conv, "removed")
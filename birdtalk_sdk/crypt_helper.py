@@ -1,12 +1,13 @@
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
 import os
 import struct
 import base64
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from ._lazy import LazyModule
+
+# cryptography 的 hazmat 后端加载较慢，第一次用到的时候再加载
+ec = LazyModule("cryptography.hazmat.primitives.asymmetric.ec")
+serialization = LazyModule("cryptography.hazmat.primitives.serialization")
+backends = LazyModule("cryptography.hazmat.backends")
+ciphers = LazyModule("cryptography.hazmat.primitives.ciphers")
 
 class ECDHKeyExchange:
     def __init__(self):
@@ -17,7 +18,7 @@ class ECDHKeyExchange:
 
     def generate_key_pair(self):
         """Generate an ECDH key pair."""
-        self.private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.private_key = ec.generate_private_key(ec.SECP256R1(), backends.default_backend())
         self.public_key = self.private_key.public_key()
         print("Key pair generated.")
 
@@ -51,7 +52,7 @@ class ECDHKeyExchange:
             raise ValueError("Private key not generated yet.")
         with open(peer_public_key_filename, 'rb') as f:
             peer_public_key_pem = f.read()
-        peer_public_key = serialization.load_pem_public_key(peer_public_key_pem, backend=default_backend())
+        peer_public_key = serialization.load_pem_public_key(peer_public_key_pem, backend=backends.default_backend())
         self.shared_key = self.private_key.exchange(ec.ECDH(), peer_public_key)
         print("Shared key generated.")
     
@@ -61,7 +62,7 @@ class ECDHKeyExchange:
         if self.private_key is None:
             raise ValueError("Private key not generated yet.")
         # peer_public_key_pem.encode('utf-8')
-        peer_public_key = serialization.load_pem_public_key(peer_public_key_pem, backend=default_backend())
+        peer_public_key = serialization.load_pem_public_key(peer_public_key_pem, backend=backends.default_backend())
         self.shared_key = self.private_key.exchange(ec.ECDH(), peer_public_key)
         print("Shared key generated.")
 
@@ -183,9 +184,9 @@ class ECDHKeyExchange:
         iv = os.urandom(16)  # 初始化向量长度为 16 字节
 
         # 创建 AES-CTR 算法对象
-        algorithm = algorithms.AES(self.shared_key)
-        mode = modes.CTR(iv)
-        cipher = Cipher(algorithm, mode, backend=default_backend())
+        algorithm = ciphers.algorithms.AES(self.shared_key)
+        mode = ciphers.modes.CTR(iv)
+        cipher = ciphers.Cipher(algorithm, mode, backend=backends.default_backend())
 
         # 使用加密器加密数据
         encryptor = cipher.encryptor()
@@ -206,9 +207,9 @@ class ECDHKeyExchange:
         encrypted_data = ciphertext[16:]
 
         # 创建 AES-CTR 算法对象
-        algorithm = algorithms.AES(self.shared_key)
-        mode = modes.CTR(iv)
-        cipher = Cipher(algorithm, mode, backend=default_backend())
+        algorithm = ciphers.algorithms.AES(self.shared_key)
+        mode = ciphers.modes.CTR(iv)
+        cipher = ciphers.Cipher(algorithm, mode, backend=backends.default_backend())
 
         # 使用解密器解密数据
         decryptor = cipher.decryptor()
@@ -0,0 +1,271 @@
+'''
+按 msgId 对收到的消息去重：重连之后推送的消息和 MsgQueryResult 同步的结果会有重叠
+
+- 最近的 capacity 个 msgId 放在一个 array 实现的环里，再用开放寻址的 array 做索引，查找是精确的
+- 从环里淘汰出去的 msgId 可以放进布隆过滤器（filter_capacity > 0 时），这部分有误判：
+  一条新消息被误认为重复的概率约为 fpp；过滤器分两代，当前这一代满了就丢掉上一代
+
+内存大约是 capacity * 24 字节，加上两代过滤器各 -filter_capacity * ln(fpp) / ln(2)^2 位；
+都在第一次用到时才分配，没有收到过消息的客户端不占用这部分内存
+'''
+import math
+from array import array
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix(x):
+    # splitmix64 的最后一步，把相邻的雪花 id 打散
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & _MASK64
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & _MASK64
+    return x ^ (x >> 31)
+
+
+class BloomFilter:
+    def __init__(self, capacity, fpp):
+        self.capacity = capacity
+        self.bits = max(64, int(-capacity * math.log(fpp) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.data = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        h = _mix(key & _MASK64)
+        h1, h2, bits = h & 0xFFFFFFFF, (h >> 32) | 1, self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def add(self, key):
+        data = self.data
+        for pos in self.positions(key):
+            data[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    # 同样参数的过滤器位置相同，可以算一次检查多个
+    def has(self, positions):
+        data = self.data
+        for pos in positions:
+            if not data[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        return self.has(self.positions(key))
+
+    def fpp(self):
+        """Expected false-positive rate at the current fill."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def clear(self):
+        self.data = bytearray(len(self.data))
+        self.count = 0
+
+
+class MsgIdDedup:
+    def __init__(self, capacity=2048, filter_capacity=0, fpp=1e-6):
+        self.capacity = capacity
+        self.filter_capacity = filter_capacity
+        self.fpp = fpp
+        self.ring = None       # 第一次 add 时分配
+        self.table = None      # 0 表示空位
+        self.filters = None    # 第一次从环里淘汰时分配
+        self.pos = 0
+        self.size = 0
+        slots = 1
+        while slots < capacity * 2:
+            slots <<= 1
+        self.mask = slots - 1
+        self.shift = 64 - slots.bit_length() + 1
+        self.stats = {"checked": 0, "recent_hits": 0, "filter_hits": 0, "pending_hits": 0}
+
+    def _allocate(self):
+        self.ring = array('q', bytes(8 * self.capacity))
+        self.table = array('q', bytes(8 * (self.mask + 1)))
+
+    def _slot(self, msg_id):
+        # Fibonacci 哈希，取乘积的高位
+        return ((msg_id * 0x9E3779B97F4A7C15) & _MASK64) >> self.shift
+
+    def _find(self, msg_id):
+        table, mask = self.table, self.mask
+        i = self._slot(msg_id)
+        while True:
+            value = table[i]
+            if value == msg_id or value == 0:
+                return i
+            i = (i + 1) & mask
+
+    def _remove(self, msg_id):
+        # 线性探测的删除：把后面同一簇里的元素往前移，不需要墓碑
+        table, mask = self.table, self.mask
+        i = self._find(msg_id)
+        if table[i] == 0:
+            return
+        j = i
+        while True:
+            table[i] = 0
+            while True:
+                j = (j + 1) & mask
+                value = table[j]
+                if value == 0:
+                    return
+                k = self._slot(value)
+                # k 不在 (i, j] 之间时，j 上的元素可以移到 i
+                if (i <= j and (k <= i or k > j)) or (i > j and k <= i and k > j):
+                    break
+            table[i] = value
+            i = j
+
+    def _remember(self, msg_id):
+        if self.size == self.capacity:
+            old = self.ring[self.pos]
+            self._remove(old)
+            if self.filter_capacity > 0:
+                if self.filters is None:
+                    self.filters = [BloomFilter(self.filter_capacity, self.fpp),
+                                    BloomFilter(self.filter_capacity, self.fpp)]
+                current = self.filters[0]
+                if current.count >= current.capacity:
+                    self.filters.reverse()
+                    current = self.filters[0]
+                    current.clear()
+                current.add(old)
+        else:
+            self.size += 1
+        self.ring[self.pos] = msg_id
+        self.pos = (self.pos + 1) % self.capacity
+        self.table[self._find(msg_id)] = msg_id
+
+    def has(self, msg_id) -> bool:
+        """Return True if msg_id was added before (filter hits may be false positives)."""
+        self.stats["checked"] += 1
+        if self.table is None:
+            return False
+        if self.table[self._find(msg_id)] == msg_id:
+            self.stats["recent_hits"] += 1
+            return True
+        if self.filters is not None:
+            positions = self.filters[0].positions(msg_id)
+            if self.filters[0].has(positions) or self.filters[1].has(positions):
+                self.stats["filter_hits"] += 1
+                return True
+        return False
+
+    def add(self, msg_id):
+        if not msg_id:
+            return
+        if self.table is None:
+            self._allocate()
+        elif self.table[self._find(msg_id)] == msg_id:
+            return
+        self._remember(msg_id)
+
+    def seen(self, msg_id) -> bool:
+        '''
+        之前见过 msg_id 时返回 True；没见过就记录下来并返回 False，msgId 为 0 的消息不去重
+        '''
+        if not msg_id:
+            return False
+        if self.has(msg_id):
+            return True
+        self.add(msg_id)
+        return False
+
+    def memory_bytes(self):
+        if self.table is None:
+            return 0
+        total = self.ring.itemsize * len(self.ring) + self.table.itemsize * len(self.table)
+        if self.filters is not None:
+            total += sum(len(f.data) for f in self.filters)
+        return total
+
+    def false_positive_rate(self):
+        if self.filters is None:
+            return 0.0
+        a, b = (f.fpp() for f in self.filters)
+        return 1 - (1 - a) * (1 - b)
+
+    def get_metrics(self):
+        metrics = dict(self.stats)
+        hits = metrics["recent_hits"] + metrics["filter_hits"] + metrics["pending_hits"]
+        metrics["hit_rate"] = hits / metrics["checked"] if metrics["checked"] else 0.0
+        metrics["recent_size"] = self.size
+        metrics["memory_bytes"] = self.memory_bytes()
+        metrics["false_positive_rate"] = self.false_positive_rate()
+        return metrics
+
+
+##################################################################
+def _check_table(dedup):
+    # 环里的每个 msgId 都能在索引里找到，索引里没有多余的元素
+    live = [dedup.ring[(dedup.pos - 1 - i) % dedup.capacity] for i in range(dedup.size)]
+    for msg_id in live:
+        assert dedup.table[dedup._find(msg_id)] == msg_id, msg_id
+    assert sum(1 for value in dedup.table if value) == len(live)
+
+
+def test_recent_window_exact():
+    import collections
+    import random
+
+    rng = random.Random(7)
+    dedup = MsgIdDedup(capacity=64)
+    assert dedup.memory_bytes() == 0     # 没有用到之前不分配
+    window = collections.deque()
+    base = 7000000000000000
+    for step in range(20000):
+        # 一部分是连续的雪花 id，一部分是重复出现的旧 id
+        msg_id = base + (step if rng.random() < 0.7 else rng.randrange(max(1, step)))
+        expected = msg_id in window
+        assert dedup.seen(msg_id) == expected, (step, msg_id)
+        if not expected:
+            window.append(msg_id)
+            if len(window) > 64:
+                window.popleft()
+        if step % 997 == 0:
+            _check_table(dedup)
+    _check_table(dedup)
+    assert dedup.memory_bytes() > 0
+
+
+def test_backshift_with_collisions():
+    dedup = MsgIdDedup(capacity=8)
+    # 找一组落在同一个槽位的 id，删除时要把同一簇里后面的元素移回来
+    target = dedup._slot(1)
+    same = [n for n in range(1, 200000) if dedup._slot(n) == target][:6]
+    others = [n for n in range(1, 200000) if dedup._slot(n) in ((target + 1) & dedup.mask, (target + 2) & dedup.mask)][:4]
+    ids = same + others
+    for msg_id in ids:
+        assert not dedup.seen(msg_id)
+    _check_table(dedup)
+    for msg_id in range(10 ** 9, 10 ** 9 + 8):   # 把上面的全部挤出去
+        assert not dedup.seen(msg_id)
+        _check_table(dedup)
+    for msg_id in ids:
+        assert not dedup.has(msg_id)
+
+
+def test_bloom_generations():
+    dedup = MsgIdDedup(capacity=8, filter_capacity=100, fpp=1e-6)
+    first = list(range(1, 101))
+    second = list(range(1001, 1101))
+    third = list(range(2001, 2201))
+    for msg_id in first + list(range(10 ** 6, 10 ** 6 + 8)):
+        dedup.add(msg_id)
+    assert dedup.filters is not None and dedup.filters[0].count == 100
+    assert all(dedup.has(msg_id) for msg_id in first)       # 被挤出环之后由过滤器记住
+    for msg_id in second:
+        dedup.add(msg_id)
+    assert all(dedup.has(msg_id) for msg_id in first)       # 上一代仍然保留
+    for msg_id in third:
+        dedup.add(msg_id)
+    # 又换了一代以后 first 已经不在任何一代里，只可能是误判
+    assert sum(dedup.has(msg_id) for msg_id in first) <= 1
+    assert all(dedup.has(msg_id) for msg_id in third[-100:])
+    assert 0 < dedup.false_positive_rate() < 1e-3
+
+
+if __name__ == "__main__":
+    test_recent_window_exact()
+    test_backshift_with_collisions()
+    test_bloom_generations()
+    print("ok")
@@ -0,0 +1,132 @@
+'''
+多个接入点的选择：并发探测 TCP 建连时间，按 happy eyeballs 的方式错开启动，先连上的胜出
+
+    pool = EndpointPool(["wss://10.0.0.1/ws?code=plain", "wss://10.0.0.2/ws?code=plain"])
+    uri = await pool.select()
+
+探测的结果会记住，后面重连时按失败次数和延迟排序；服务端的重定向（redirect -> ip:port）
+替换 uri 里的主机和端口，作为新的首选接入点
+'''
+import asyncio
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+
+def get_host_port(uri):
+    parts = urlsplit(uri)
+    port = parts.port
+    if port is None:
+        port = 443 if parts.scheme in ("wss", "https") else 80
+    return parts.hostname, port
+
+
+# target 为 "ip:port" 或者完整的 uri
+def redirect_uri(uri, target):
+    if "://" in target:
+        return target
+    parts = urlsplit(uri)
+    netloc = target
+    if parts.username:
+        netloc = parts.netloc.rsplit("@", 1)[0] + "@" + target
+    return urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
+
+
+async def probe(uri, timeout=3.0):
+    """Return the TCP connect time to uri in seconds."""
+    host, port = get_host_port(uri)
+    started = time.perf_counter()
+    _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    rtt = time.perf_counter() - started
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return rtt
+
+
+class EndpointPool:
+    '''
+    stagger: 前一个候选还没有结果时，隔多久启动下一个候选的探测
+    '''
+    def __init__(self, uris, stagger=0.25, timeout=3.0):
+        if isinstance(uris, str):
+            uris = [uris]
+        self.uris = list(uris)
+        self.stagger = stagger
+        self.timeout = timeout
+        self.rtt = {}         # uri -> 最近一次探测的建连时间
+        self.failures = {}    # uri -> 连续失败次数
+        self.preferred = None  # 重定向得到的接入点
+
+    def order(self):
+        def key(item):
+            index, uri = item
+            return (uri != self.preferred, self.failures.get(uri, 0), self.rtt.get(uri, float("inf")), index)
+        return [uri for _, uri in sorted(enumerate(self.uris), key=key)]
+
+    def mark_failed(self, uri):
+        self.failures[uri] = self.failures.get(uri, 0) + 1
+        self.rtt.pop(uri, None)
+        if uri == self.preferred:
+            self.preferred = None
+
+    def mark_ok(self, uri):
+        self.failures.pop(uri, None)
+
+    def redirect(self, current, target):
+        uri = redirect_uri(current, target)
+        if uri not in self.uris:
+            self.uris.append(uri)
+        self.failures.pop(uri, None)
+        self.preferred = uri
+        return uri
+
+    async def select(self, exclude=()):
+        '''
+        返回最先完成 TCP 建连的候选，全部失败时返回 None
+        只有一个候选（或者有重定向的首选）时不探测，直接交给 websocket 去连接
+        '''
+        candidates = [uri for uri in self.order() if uri not in exclude]
+        if not candidates:
+            return None
+        if len(candidates) == 1 or candidates[0] == self.preferred:
+            return candidates[0]
+
+        tasks = {}
+        winner = None
+        try:
+            for uri in candidates:
+                tasks[asyncio.ensure_future(probe(uri, self.timeout))] = uri
+                winner = await self._wait_first(tasks, self.stagger)
+                if winner is not None:
+                    return winner
+            while tasks and winner is None:
+                winner = await self._wait_first(tasks, None)
+            return winner
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _wait_first(self, tasks, timeout):
+        # 等到有一个探测成功，或者超时；失败的探测从 tasks 里去掉，并且立即启动下一个
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while tasks:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                return None
+            failed = False
+            for task in done:
+                uri = tasks.pop(task)
+                if task.exception() is None:
+                    self.rtt[uri] = task.result()
+                    return uri
+                print(f"endpoint {uri} unreachable: {task.exception()!r}")
+                self.mark_failed(uri)
+                failed = True
+            if failed and timeout is not None:
+                return None
+        return None
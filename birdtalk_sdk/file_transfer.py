@@ -0,0 +1,293 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+from . import msg_pb2
+
+
+# 预检应答的 chunkIndex 是 0，等待它时用这个单独的 key，不会和第 0 块的应答混淆
+PREFLIGHT = -1
+
+
+class FileTransferError(Exception):
+    pass
+
+
+def check_can_wait(client):
+    # 读循环正在执行当前的处理函数，应答读不到，直接失败而不是等到超时
+    if client.in_inline_dispatch():
+        raise FileTransferError("cannot wait for a transfer reply inside a message handler when inbox_size=0")
+
+
+class HashCache:
+    '''
+    文件哈希缓存：(路径, 大小, 修改时间) -> 哈希值，文件没有变化就不重新计算
+    保存为一个 json 文件，写入时先写临时文件再替换，避免写坏
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}    # 绝对路径 -> [size, mtime_ns, hash_type, hash]
+        self.dirty = False
+        if filename:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (IOError, ValueError) as e:
+            print(f"Error: cannot load hash cache '{self.filename}': {e}")
+            self.entries = {}
+
+    def save(self):
+        if not self.filename or not self.dirty:
+            return
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, separators=(',', ':'))
+        os.replace(tmp, self.filename)
+        self.dirty = False
+
+    def get(self, path, size, mtime_ns, hash_type):
+        entry = self.entries.get(path)
+        if entry and entry[0] == size and entry[1] == mtime_ns and entry[2] == hash_type:
+            return entry[3]
+        return None
+
+    def put(self, path, size, mtime_ns, hash_type, code):
+        self.entries[path] = [size, mtime_ns, hash_type, code]
+        self.dirty = True
+
+
+def _hash_file_sync(path, hash_type, chunk_size):
+    h = hashlib.new(hash_type)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_bytes(hash_type, data):
+    return hashlib.new(hash_type, data).hexdigest()
+
+
+def _read_chunk(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class FileUploader:
+    '''
+    分块上传，先只发送哈希做预检，服务端已经有相同内容的文件时直接返回 uuidName，不再上传数据
+    文件哈希在线程池里流式计算，结果缓存在 HashCache 里
+    '''
+    def __init__(self, client, cache=None, hash_type="sha256", chunk_size=256 * 1024, timeout=30.0):
+        self.client = client
+        self.cache = cache if cache is not None else HashCache()
+        self.hash_type = hash_type
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.waiters = {}    # (sendId, chunkIndex) -> Future
+        self.stats = {"dedup_hits": 0, "uploads": 0, "hash_cache_hits": 0, "bytes_sent": 0}
+
+    async def hash_file(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        code = self.cache.get(path, st.st_size, st.st_mtime_ns, self.hash_type)
+        if code is not None:
+            self.stats["hash_cache_hits"] += 1
+            return code, st.st_size
+        loop = asyncio.get_running_loop()
+        code = await loop.run_in_executor(None, _hash_file_sync, path, self.hash_type, 1024 * 1024)
+        # 只在内存里更新，客户端停止时统一保存，避免每个文件都重写整个缓存文件
+        self.cache.put(path, st.st_size, st.st_mtime_ns, self.hash_type, code)
+        return code, st.st_size
+
+    async def upload_file(self, path, file_type="", group_id=0) -> str:
+        code, size = await self.hash_file(path)
+        loop = asyncio.get_running_loop()
+
+        async def read(offset, length):
+            return await loop.run_in_executor(None, _read_chunk, path, offset, length)
+
+        return await self._upload(os.path.basename(path), size, code, read, file_type, group_id)
+
+    async def upload_bytes(self, data, file_name, file_type="", group_id=0) -> str:
+        loop = asyncio.get_running_loop()
+        code = await loop.run_in_executor(None, _hash_bytes, self.hash_type, data)
+
+        async def read(offset, length):
+            return data[offset:offset + length]
+
+        return await self._upload(file_name, len(data), code, read, file_type, group_id)
+
+    def _create_req(self, send_id, file_name, size, code, file_type, group_id, chunk_count):
+        req = msg_pb2.MsgUploadReq()
+        req.fileName = file_name
+        req.fileSize = size
+        req.hashType = self.hash_type
+        req.hashCode = code
+        req.fileType = file_type
+        req.sendId = send_id
+        req.chunkCount = chunk_count
+        req.chunkSize = self.chunk_size
+        req.groupId = group_id
+
+        msg = msg_pb2.Msg()
+        msg.msgType = msg_pb2.ComMsgType.MsgTUpload
+        msg.version = 1
+        msg.tm = self.client.get_current_timestamp()
+        msg.plainMsg.uploadReq.CopyFrom(req)
+        return msg
+
+    async def _request(self, msg, send_id, chunk_index):
+        check_can_wait(self.client)
+        key = (send_id, chunk_index)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[key] = future
+        try:
+            # 直接发送编码好的数据：client.send 会打印整个消息，数据块很大时很慢
+            await self.client.send_encoded(msg.SerializeToString(), msg.msgType)
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise FileTransferError(f"upload reply timeout, sendId={send_id} chunk={chunk_index}")
+        finally:
+            self.waiters.pop(key, None)
+
+    async def _upload(self, file_name, size, code, read, file_type, group_id) -> str:
+        send_id = self.client.next_send_id()
+        chunk_count = max(1, (size + self.chunk_size - 1) // self.chunk_size)
+
+        # 预检：只带哈希，不带数据
+        msg = self._create_req(send_id, file_name, size, code, file_type, group_id, chunk_count)
+        reply = await self._request(msg, send_id, PREFLIGHT)
+        if reply.uuidName and reply.result == "ok":
+            self.stats["dedup_hits"] += 1
+            print(f"file {file_name} already on server: {reply.uuidName}")
+            return reply.uuidName
+
+        for index in range(chunk_count):
+            data = await read(index * self.chunk_size, self.chunk_size)
+            msg = self._create_req(send_id, file_name, size, code, file_type, group_id, chunk_count)
+            msg.plainMsg.uploadReq.chunkIndex = index
+            msg.plainMsg.uploadReq.fileData = data
+            reply = await self._request(msg, send_id, index)
+            if reply.result != "ok":
+                raise FileTransferError(f"upload {file_name} chunk {index} failed: {reply.result} {reply.detail}")
+            self.stats["bytes_sent"] += len(data)
+
+        if not reply.uuidName:
+            raise FileTransferError(f"upload {file_name} finished without uuidName")
+        self.stats["uploads"] += 1
+        return reply.uuidName
+
+    def on_upload_reply(self, reply):
+        # 预检返回之前不会发送数据块，所以同一个 sendId 在等预检时，收到的一定是预检的应答；
+        # 预检完成以后只按 chunkIndex 匹配，没有对应的等待者就丢掉
+        future = self.waiters.get((reply.sendId, PREFLIGHT))
+        if future is None:
+            future = self.waiters.get((reply.sendId, reply.chunkIndex))
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+
+class FileDownloader:
+    '''
+    通过 MsgDownloadReq 按偏移量分块下载，下载过的内容放在一个按字节数限制的 LRU 缓存里
+    '''
+    def __init__(self, client, timeout=30.0, cache_bytes=32 * 1024 * 1024):
+        self.client = client
+        self.timeout = timeout
+        self.cache_bytes = cache_bytes
+        self.cache = collections.OrderedDict()   # fileName -> bytes
+        self.cached_size = 0
+        self.waiters = {}      # sendId -> Future
+        self.loading = {}      # fileName -> Future，同一个文件并发请求只下载一次
+        self.stats = {"downloads": 0, "cache_hits": 0, "bytes_received": 0}
+
+    async def download(self, file_name) -> bytes:
+        data = self.cache.get(file_name)
+        if data is not None:
+            self.cache.move_to_end(file_name)
+            self.stats["cache_hits"] += 1
+            return data
+        task = self.loading.get(file_name)
+        if task is None:
+            task = asyncio.ensure_future(self._download(file_name))
+            self.loading[file_name] = task
+            task.add_done_callback(lambda _: self.loading.pop(file_name, None))
+        return await asyncio.shield(task)
+
+    async def _request(self, file_name, offset):
+        send_id = str(self.client.next_send_id())
+        req = msg_pb2.MsgDownloadReq()
+        req.sendId = send_id
+        req.fileName = file_name
+        req.offset = offset
+
+        msg = msg_pb2.Msg()
+        msg.msgType = msg_pb2.ComMsgType.MsgTDownload
+        msg.version = 1
+        msg.tm = self.client.get_current_timestamp()
+        msg.plainMsg.downloadReq.CopyFrom(req)
+
+        check_can_wait(self.client)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[send_id] = future
+        try:
+            await self.client.send_encoded(msg.SerializeToString(), msg.msgType)
+            reply = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise FileTransferError(f"download reply timeout, file={file_name} offset={offset}")
+        finally:
+            self.waiters.pop(send_id, None)
+        if reply.result and reply.result != "ok":
+            raise FileTransferError(f"download {file_name} failed: {reply.result} {reply.detail}")
+        return reply
+
+    async def _download(self, file_name) -> bytes:
+        parts = []
+        offset = 0
+        hash_type = hash_code = ""
+        while True:
+            reply = await self._request(file_name, offset)
+            parts.append(reply.data)
+            offset += len(reply.data)
+            hash_type, hash_code = reply.hashType, reply.hashCode
+            if not reply.data:
+                break
+            if reply.size:
+                if offset >= reply.size:
+                    break
+            elif reply.chunkIndex + 1 >= reply.chunkCount:
+                break
+
+        data = b"".join(parts)
+        if hash_code and hash_type in hashlib.algorithms_available:
+            if hashlib.new(hash_type, data).hexdigest() != hash_code.lower():
+                raise FileTransferError(f"download {file_name}: hash mismatch")
+        self.stats["downloads"] += 1
+        self.stats["bytes_received"] += len(data)
+        self._remember(file_name, data)
+        return data
+
+    def _remember(self, file_name, data):
+        if len(data) > self.cache_bytes:
+            return
+        self.cache[file_name] = data
+        self.cached_size += len(data)
+        while self.cached_size > self.cache_bytes:
+            _, old = self.cache.popitem(last=False)
+            self.cached_size -= len(old)
+
+    def on_download_reply(self, reply):
+        future = self.waiters.get(reply.sendId)
+        if future is not None and not future.done():
+            future.set_result(reply)
@@ -0,0 +1,88 @@
+import asyncio
+
+
+class Inbox:
+    '''
+    入站消息的分发阶段：同一个会话（key）的消息按到达顺序处理，不同会话之间并发处理
+    每个 key 一个有界队列，另外总的待处理数量也有上限；满了之后 put 会等待，
+    读 socket 的循环也就跟着暂停，不会无限制地堆积内存
+    某个 key 的队列处理空了以后，对应的任务退出，不会给每个会话常驻一个任务
+    '''
+    def __init__(self, handler, max_pending=1000, max_per_key=100):
+        self.handler = handler
+        self.max_per_key = max_per_key
+        self.slots_total = max_pending
+        self.slots = asyncio.Semaphore(max_pending)
+        self.queues = {}     # key -> asyncio.Queue
+        self.workers = {}    # key -> asyncio.Task
+        self.putters = {}    # key -> 正在等待队列空位的 put 数
+        self.pending = 0
+        self.generation = 0  # close() 之后，被取消的旧任务不再修改计数
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def put(self, key, msg):
+        await self.slots.acquire()
+        self.pending += 1
+        self.idle.clear()
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = asyncio.Queue(self.max_per_key)
+            self.queues[key] = queue
+        if queue.full():
+            # 等待期间 worker 可能处理完退出，队列要保留给这里，不能被注销
+            self.putters[key] = self.putters.get(key, 0) + 1
+            try:
+                await queue.put(msg)
+            finally:
+                count = self.putters.get(key, 1) - 1
+                if count > 0:
+                    self.putters[key] = count
+                else:
+                    self.putters.pop(key, None)
+        else:
+            queue.put_nowait(msg)
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self._worker(key, queue, self.generation))
+
+    async def _worker(self, key, queue, generation):
+        slots = self.slots
+        try:
+            while True:
+                try:
+                    msg = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                try:
+                    await self.handler(msg)
+                except Exception as e:
+                    print(f"Error handling message for {key}: {e!r}")
+                finally:
+                    slots.release()
+                    if generation == self.generation:
+                        self.pending -= 1
+                        if self.pending == 0:
+                            self.idle.set()
+        finally:
+            # 这里和 get_nowait 之间没有 await，不会和 put 产生竞争
+            if generation == self.generation:
+                self.workers.pop(key, None)
+                if queue.empty() and key not in self.putters and self.queues.get(key) is queue:
+                    self.queues.pop(key, None)
+
+    def get_pending_count(self):
+        return self.pending
+
+    # 等待当前所有消息处理完
+    async def join(self):
+        await self.idle.wait()
+
+    def close(self):
+        for task in list(self.workers.values()):
+            task.cancel()
+        self.workers.clear()
+        self.queues.clear()
+        self.generation += 1
+        self.slots = asyncio.Semaphore(self.slots_total)
+        self.pending = 0
+        self.idle.set()
@@ -0,0 +1,315 @@
+'''
+高频消息的预编码模板：心跳、回执、短文本聊天每次只有少数几个字段不同，
+这里把 Msg 信封中不变的部分（version、msgType、plainMsg 和负载的 tag 等）预先序列化好，
+发送时只在 wire format 层面拼接可变字段和长度前缀，输出和 SerializeToString 的结果逐字节一致
+
+    tpl = chat_template(from_id=10001)
+    data = tpl.render(tm=tm, chat_tm=chat_tm, send_id=send_id, to_id=10003, data=b"hello")
+
+负载消息（例如 MsgChat）本身用一个复用的 protobuf 对象编码：常量字段只设置一次，
+每次只赋值可变字段，交给 C 实现的序列化；纯 Python 逐字段编码 varint 反而比它慢
+可变字段：Msg 顶层的标量字段（tm 等），以及 plainMsg.<负载>.<字段> 的标量字段
+模板复用内部对象，不是线程安全的，每个事件循环/线程各用各的模板
+'''
+import time
+from google.protobuf.descriptor import FieldDescriptor
+from . import msg_pb2
+
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LEN = 2
+_WIRE_FIXED32 = 5
+
+_VARINT_TYPES = (
+    FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
+    FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_UINT32,
+    FieldDescriptor.TYPE_ENUM, FieldDescriptor.TYPE_BOOL,
+)
+
+_SMALL_VARINTS = [bytes((i,)) for i in range(128)]
+
+
+def encode_varint(value):
+    if 0 <= value < 0x80:
+        return _SMALL_VARINTS[value]
+    if value < 0:
+        value += 1 << 64    # 负数按 64 位补码编码，固定 10 字节
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def split_fields(data):
+    """Split serialized bytes into [(field_number, raw_bytes_with_tag)]."""
+    fields = []
+    pos = 0
+    while pos < len(data):
+        start = pos
+        key, pos = _read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == _WIRE_VARINT:
+            _, pos = _read_varint(data, pos)
+        elif wire_type == _WIRE_FIXED64:
+            pos += 8
+        elif wire_type == _WIRE_LEN:
+            size, pos = _read_varint(data, pos)
+            pos += size
+        elif wire_type == _WIRE_FIXED32:
+            pos += 4
+        else:
+            raise ValueError(f"unsupported wire type {wire_type}")
+        fields.append((key >> 3, data[start:pos]))
+    return fields
+
+
+class _VarintSlot:
+    '''
+    信封顶层的一个可变整数字段；tm 这类字段连续很多条消息都是同一个值，缓存上一次的编码
+    '''
+    def __init__(self, alias, field):
+        if field.type not in _VARINT_TYPES or field.label == FieldDescriptor.LABEL_REPEATED:
+            raise ValueError(f"field '{field.full_name}' is not a singular integer field")
+        self.alias = alias
+        self.tag = encode_varint(field.number << 3 | _WIRE_VARINT)
+        self.last_value = 0
+        self.last_bytes = b""
+
+    def encode(self, value):
+        if value == self.last_value:
+            return self.last_bytes
+        # proto3 默认值不输出
+        encoded = self.tag + encode_varint(int(value)) if value else b""
+        self.last_value = value
+        self.last_bytes = encoded
+        return encoded
+
+
+class MsgTemplate:
+    '''
+    prototype: 填好了不变字段的 Msg，负载必须是 plainMsg 里的某一种消息
+    variables: {别名: 字段路径}，例如 {"tm": "tm", "data": "plainMsg.chatData.data"}
+    '''
+    def __init__(self, prototype, variables):
+        if prototype.WhichOneof("message") != "plainMsg":
+            raise ValueError("template prototype must carry a plainMsg payload")
+        self.msg_type = prototype.msgType
+        self.aliases = frozenset(variables)
+
+        payload_name = prototype.plainMsg.WhichOneof("message")
+        top_slots = []
+        self.payload_vars = []   # (alias, field_name, default)
+        for alias, path in variables.items():
+            parts = path.split(".")
+            if len(parts) == 1:
+                field = prototype.DESCRIPTOR.fields_by_name.get(parts[0])
+                if field is None:
+                    raise ValueError(f"Msg has no field '{parts[0]}'")
+                top_slots.append((field.number, _VarintSlot(alias, field)))
+                continue
+            if len(parts) != 3 or parts[0] != "plainMsg":
+                raise ValueError(f"template path '{path}' must be 'field' or 'plainMsg.<payload>.<field>'")
+            if payload_name is None:
+                payload_name = parts[1]
+            elif parts[1] != payload_name:
+                raise ValueError(f"template payload is '{payload_name}', not '{parts[1]}'")
+            payload_field = msg_pb2.MsgPlain.DESCRIPTOR.fields_by_name.get(parts[1])
+            if payload_field is None:
+                raise ValueError(f"MsgPlain has no payload '{parts[1]}'")
+            field = payload_field.message_type.fields_by_name.get(parts[2])
+            if field is None:
+                raise ValueError(f"'{payload_field.message_type.full_name}' has no field '{parts[2]}'")
+            if field.label == FieldDescriptor.LABEL_REPEATED or field.message_type is not None:
+                raise ValueError(f"field '{field.full_name}' is not a singular scalar field")
+            self.payload_vars.append((alias, parts[2], field.default_value))
+
+        if payload_name is None:
+            raise ValueError("template prototype has no payload")
+        payload_field = msg_pb2.MsgPlain.DESCRIPTOR.fields_by_name[payload_name]
+
+        # 复用的负载对象，常量字段只设置一次
+        self.payload = type(getattr(prototype.plainMsg, payload_name))()
+        self.payload.CopyFrom(getattr(prototype.plainMsg, payload_name))
+        self.payload_tag = encode_varint(payload_field.number << 3 | _WIRE_LEN)
+
+        # 信封顶层：去掉可变字段和 plainMsg 之后序列化，按字段号和可变字段合并
+        head = msg_pb2.Msg()
+        head.CopyFrom(prototype)
+        head.ClearField("plainMsg")
+        for _, slot in top_slots:
+            head.ClearField(variables[slot.alias])
+        consts = split_fields(head.SerializeToString())
+        plain_number = msg_pb2.Msg.DESCRIPTOR.fields_by_name["plainMsg"].number
+        if any(number > plain_number for number, _ in consts + top_slots):
+            raise ValueError("fields after plainMsg are not supported in templates")
+        self.head = []
+        for _, piece in sorted(consts + top_slots, key=lambda item: item[0]):
+            if isinstance(piece, bytes) and self.head and isinstance(self.head[-1], bytes):
+                self.head[-1] += piece
+            else:
+                self.head.append(piece)
+        self.plain_tag = encode_varint(plain_number << 3 | _WIRE_LEN)
+
+    def render(self, **values) -> bytes:
+        if not self.aliases.issuperset(values):
+            unknown = set(values).difference(self.aliases)
+            raise TypeError(f"unknown template variables: {', '.join(sorted(unknown))}")
+
+        payload = self.payload
+        for alias, name, default in self.payload_vars:
+            setattr(payload, name, values.get(alias, default))
+        body = payload.SerializeToString()
+        plain = self.payload_tag + encode_varint(len(body)) + body
+
+        out = []
+        for piece in self.head:
+            if isinstance(piece, bytes):
+                out.append(piece)
+            else:
+                out.append(piece.encode(values.get(piece.alias, 0)))
+        out.append(self.plain_tag)
+        out.append(encode_varint(len(plain)))
+        out.append(plain)
+        return b"".join(out)
+
+
+##################################################################
+def heartbeat_template(user_id=0) -> MsgTemplate:
+    msg = msg_pb2.Msg()
+    msg.version = 1
+    msg.msgType = msg_pb2.ComMsgType.MsgTHeartBeat
+    msg.plainMsg.heartBeat.userId = user_id
+    return MsgTemplate(msg, {"tm": "tm", "hb_tm": "plainMsg.heartBeat.tm"})
+
+
+def chat_template(from_id, chat_type=msg_pb2.ChatType.ChatTypeP2P,
+                  msg_type=msg_pb2.ChatMsgType.TEXT) -> MsgTemplate:
+    msg = msg_pb2.Msg()
+    msg.version = 1
+    msg.msgType = msg_pb2.ComMsgType.MsgTChatMsg
+    chat = msg.plainMsg.chatData
+    chat.fromId = from_id
+    chat.msgType = msg_type
+    chat.chatType = chat_type
+    return MsgTemplate(msg, {
+        "tm": "tm",
+        "to_id": "plainMsg.chatData.toId",
+        "chat_tm": "plainMsg.chatData.tm",
+        "send_id": "plainMsg.chatData.sendId",
+        "data": "plainMsg.chatData.data",
+    })
+
+
+# 回执：recv_ok / read_ok 为送达、已读的时间戳
+def chat_reply_template(from_id) -> MsgTemplate:
+    msg = msg_pb2.Msg()
+    msg.version = 1
+    msg.msgType = msg_pb2.ComMsgType.MsgTChatReply
+    msg.plainMsg.chatReply.fromId = from_id
+    return MsgTemplate(msg, {
+        "tm": "tm",
+        "msg_id": "plainMsg.chatReply.msgId",
+        "send_id": "plainMsg.chatReply.sendId",
+        "recv_ok": "plainMsg.chatReply.recvOk",
+        "read_ok": "plainMsg.chatReply.readOk",
+        "user_id": "plainMsg.chatReply.userId",
+    })
+
+
+###############################################################
+def _build_chat(from_id, chat_type, msg_type, tm, chat_tm, send_id, to_id, data):
+    msg = msg_pb2.Msg()
+    msg.version = 1
+    msg.msgType = msg_pb2.ComMsgType.MsgTChatMsg
+    msg.tm = tm
+    chat = msg_pb2.MsgChat()
+    chat.fromId = from_id
+    chat.toId = to_id
+    chat.tm = chat_tm
+    chat.sendId = send_id
+    chat.msgType = msg_type
+    chat.chatType = chat_type
+    chat.data = data
+    msg.plainMsg.chatData.CopyFrom(chat)
+    return msg.SerializeToString()
+
+
+def test_chat_template_identical():
+    cases = [
+        (10001, msg_pb2.ChatType.ChatTypeP2P, msg_pb2.ChatMsgType.TEXT),
+        (0, msg_pb2.ChatType.ChatTypeGroup, msg_pb2.ChatMsgType.IMAGE),
+        (-5, msg_pb2.ChatType.ChatTypeNone, msg_pb2.ChatMsgType.PLUGIN),
+    ]
+    values = [
+        (0, 0, 0, 0, b""),
+        (int(time.time()), int(time.time() * 1000), 1 << 50, 10003, "你好".encode('utf-8')),
+        (-1, 1, -(1 << 63), (1 << 63) - 1, b"\x00" * 300),
+        (127, 128, 16383, 16384, b"x" * 127),
+    ]
+    for from_id, chat_type, msg_type in cases:
+        tpl = chat_template(from_id, chat_type, msg_type)
+        for tm, chat_tm, send_id, to_id, data in values:
+            expected = _build_chat(from_id, chat_type, msg_type, tm, chat_tm, send_id, to_id, data)
+            got = tpl.render(tm=tm, chat_tm=chat_tm, send_id=send_id, to_id=to_id, data=data)
+            assert got == expected, (got, expected)
+
+
+def test_heartbeat_and_reply_template_identical():
+    for user_id in (0, 10003, -7):
+        for tm in (0, 1, int(time.time())):
+            msg = msg_pb2.Msg()
+            msg.version = 1
+            msg.msgType = msg_pb2.ComMsgType.MsgTHeartBeat
+            msg.tm = tm
+            msg.plainMsg.heartBeat.userId = user_id
+            msg.plainMsg.heartBeat.tm = tm
+            assert heartbeat_template(user_id).render(tm=tm, hb_tm=tm) == msg.SerializeToString()
+
+            msg = msg_pb2.Msg()
+            msg.version = 1
+            msg.msgType = msg_pb2.ComMsgType.MsgTChatReply
+            msg.tm = tm
+            reply = msg.plainMsg.chatReply
+            reply.fromId = user_id
+            reply.msgId = tm * 3
+            reply.sendId = tm + 1
+            reply.readOk = tm
+            reply.userId = 10001
+            got = chat_reply_template(user_id).render(
+                tm=tm, msg_id=tm * 3, send_id=tm + 1, read_ok=tm, user_id=10001)
+            assert got == msg.SerializeToString()
+
+
+def test_template_with_params_roundtrip():
+    msg = msg_pb2.Msg()
+    msg.version = 1
+    msg.keyPrint = 123456789
+    msg.msgType = msg_pb2.ComMsgType.MsgTChatMsg
+    msg.plainMsg.chatData.params["k"] = "v"
+    msg.plainMsg.chatData.devId = "dev"
+    tpl = MsgTemplate(msg, {"tm": "tm", "text": "plainMsg.chatData.data", "ref": "plainMsg.chatData.refMessageId"})
+    msg.tm = 99
+    msg.plainMsg.chatData.data = b"abc"
+    msg.plainMsg.chatData.refMessageId = 5
+    assert tpl.render(tm=99, text=b"abc", ref=5) == msg.SerializeToString()
+
+
+if __name__ == "__main__":
+    test_chat_template_identical()
+    test_heartbeat_and_reply_template_identical()
+    test_template_with_params_roundtrip()
+    print("ok")
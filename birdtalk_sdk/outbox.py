@@ -0,0 +1,161 @@
+'''
+聊天消息的持久化发件箱：发送之前先写入追加日志，收到 MsgChatReply.sendOk 后标记完成，
+重连进入 READY 后把没有确认的消息用原来的 sendId 重发（服务端按 sendId 去重）
+
+fsync 是成批做的：同一时间写入的记录只等一次 fsync，fsync 在线程池里执行，不阻塞事件循环
+
+日志格式：
+文件头  magic(4) + version(1)
+每条    kind(1) + sendId(8) + 长度(4) + crc32(4) + 数据；kind 为 PUT 时数据是编码好的 Msg，DONE 时为空
+进程崩溃时最后一条可能只写了一半，加载时从第一条不完整或者校验失败的记录处截断
+'''
+import asyncio
+import collections
+import os
+import struct
+import zlib
+
+MAGIC = b"BTOB"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sB")
+_RECORD = struct.Struct("<BqII")
+
+KIND_PUT = 0
+KIND_DONE = 1
+
+
+class Outbox:
+    '''
+    compact_after: 已完成的记录超过这个数量（并且比待确认的多）时重写日志
+    '''
+    def __init__(self, filename, compact_after=10000):
+        self.filename = filename
+        self.compact_after = compact_after
+        self.pending = collections.OrderedDict()   # sendId -> 编码好的消息
+        self.garbage = 0
+        self.file = None
+        self.waiters = []        # 等待下一次 fsync 的 future
+        self.sync_task = None
+        self.stats = {"puts": 0, "done": 0, "fsyncs": 0, "resent": 0}
+        self.load()
+
+    def load(self):
+        self.pending.clear()
+        self.garbage = 0
+        valid = 0
+        try:
+            with open(self.filename, 'rb') as f:
+                header = f.read(_HEADER.size)
+                if len(header) == _HEADER.size and _HEADER.unpack(header) == (MAGIC, FORMAT_VERSION):
+                    valid = _HEADER.size
+                    while True:
+                        head = f.read(_RECORD.size)
+                        if len(head) < _RECORD.size:
+                            break
+                        kind, send_id, size, crc = _RECORD.unpack(head)
+                        data = f.read(size)
+                        if len(data) < size or zlib.crc32(data) != crc:
+                            break
+                        if kind == KIND_PUT:
+                            self.pending[send_id] = data
+                        elif self.pending.pop(send_id, None) is not None:
+                            self.garbage += 2
+                        valid += _RECORD.size + size
+                elif header:
+                    print(f"Error: '{self.filename}' is not an outbox log, starting a new one")
+        except FileNotFoundError:
+            pass
+        if valid == 0:
+            self.file = open(self.filename, 'wb')
+            self.file.write(_HEADER.pack(MAGIC, FORMAT_VERSION))
+            self.file.flush()
+        else:
+            self.file = open(self.filename, 'r+b')
+            self.file.truncate(valid)    # 丢掉写了一半的尾部
+            self.file.seek(valid)
+        if self.garbage > self.compact_after:
+            self.compact()
+
+    def _append(self, kind, send_id, data=b""):
+        self.file.write(_RECORD.pack(kind, send_id, len(data), zlib.crc32(data)))
+        if data:
+            self.file.write(data)
+
+    async def put(self, send_id, data: bytes):
+        """Append a message and wait until it is on disk."""
+        self._append(KIND_PUT, send_id, data)
+        self.pending[send_id] = data
+        self.stats["puts"] += 1
+        await self.sync()
+
+    def done(self, send_id):
+        # 完成标记不等 fsync：丢了只会多重发一次，sendId 相同，服务端会去重
+        if self.pending.pop(send_id, None) is None:
+            return
+        self._append(KIND_DONE, send_id)
+        self.stats["done"] += 1
+        self.garbage += 2
+        if self.garbage > self.compact_after and self.garbage > 2 * len(self.pending) and self.sync_task is None:
+            self.compact()
+
+    async def sync(self):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        if self.sync_task is None:
+            self.sync_task = asyncio.ensure_future(self._sync_loop())
+        await future
+
+    async def _sync_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.waiters:
+                # 这一批之后到达的写入等下一次 fsync
+                batch, self.waiters = self.waiters, []
+                try:
+                    self.file.flush()
+                    await loop.run_in_executor(None, os.fsync, self.file.fileno())
+                    self.stats["fsyncs"] += 1
+                except Exception as e:
+                    for future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for future in batch:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            self.sync_task = None
+
+    def compact(self):
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION))
+            for send_id, data in self.pending.items():
+                f.write(_RECORD.pack(KIND_PUT, send_id, len(data), zlib.crc32(data)))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp, self.filename)
+        self.file = open(self.filename, 'ab')
+        self.garbage = 0
+
+    def pending_items(self):
+        return list(self.pending.items())
+
+    def get_metrics(self):
+        metrics = dict(self.stats)
+        metrics["pending"] = len(self.pending)
+        metrics["batch"] = metrics["puts"] / metrics["fsyncs"] if metrics["fsyncs"] else 0.0
+        return metrics
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
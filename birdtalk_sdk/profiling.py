@@ -0,0 +1,173 @@
+'''
+运行时的诊断工具，不需要重启进程就可以打开和关闭
+
+    client.enable_profiling(sample_every=10, slow_ms=50)   # 每种消息每 10 条计时一次
+    print(client.get_profile())
+    print(client.memory_report())                          # 第一次调用时开始 tracemalloc
+    install_signal_handler(client)                         # kill -USR1 <pid> 打开/输出并关闭
+
+处理时间按 ComMsgType 统计；超过 slow_ms 的处理通过 logging 发出警告
+'''
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger("birdtalk_sdk")
+
+_SDK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class HandlerProfiler:
+    def __init__(self, sample_every=1, slow_ms=100.0):
+        self.sample_every = max(1, int(sample_every))
+        self.slow_ms = slow_ms
+        self.seen = {}     # msgType -> 收到的条数
+        self.stats = {}    # msgType -> [计时的条数, 总耗时, 最大耗时, 超时的条数]
+        self.started = time.monotonic()
+
+    async def run(self, handler, msg):
+        msg_type = msg.msgType
+        count = self.seen.get(msg_type, 0) + 1
+        self.seen[msg_type] = count
+        if count % self.sample_every:
+            return await handler(msg)
+        started = time.perf_counter()
+        try:
+            return await handler(msg)
+        finally:
+            self._record(msg_type, (time.perf_counter() - started) * 1000)
+
+    def _record(self, msg_type, elapsed_ms):
+        stat = self.stats.get(msg_type)
+        if stat is None:
+            stat = self.stats[msg_type] = [0, 0.0, 0.0, 0]
+        stat[0] += 1
+        stat[1] += elapsed_ms
+        if elapsed_ms > stat[2]:
+            stat[2] = elapsed_ms
+        if elapsed_ms > self.slow_ms:
+            stat[3] += 1
+            logger.warning("slow handler for %s: %.1f ms", _type_name(msg_type), elapsed_ms)
+
+    def report(self):
+        result = {}
+        for msg_type, count in self.seen.items():
+            timed, total, worst, slow = self.stats.get(msg_type, (0, 0.0, 0.0, 0))
+            result[_type_name(msg_type)] = {
+                "received": count,
+                "timed": timed,
+                "avg_ms": total / timed if timed else 0.0,
+                "max_ms": worst,
+                "slow": slow,
+            }
+        return {"seconds": time.monotonic() - self.started, "handlers": result}
+
+
+def _type_name(msg_type):
+    from . import msg_pb2
+    try:
+        return msg_pb2.ComMsgType.Name(msg_type)
+    except ValueError:
+        return str(msg_type)
+
+
+##################################################################
+# 内存
+def _size_of(obj):
+    try:
+        return sys.getsizeof(obj)
+    except TypeError:
+        return 0
+
+
+def component_report(client):
+    '''
+    按组件统计客户端持有的对象：缓存、队列、等待中的 future、发件箱、会话列表和全文索引；bytes 是粗略的估计
+    '''
+    report = {}
+
+    def add(name, items, size):
+        report[name] = {"items": items, "bytes": size}
+
+    if client.inbox is not None:
+        queued = sum(q.qsize() for q in client.inbox.queues.values())
+        add("inbox", queued, sum(_size_of(q._queue) for q in client.inbox.queues.values()))
+    add("subscribers", sum(q.qsize() for q in client.msgSubscribers),
+        sum(_size_of(q._queue) for q in client.msgSubscribers))
+    add("templates", len(client.templates), _size_of(client.templates))
+    if client.dedup is not None:
+        add("dedup", client.dedup.size, client.dedup.memory_bytes())
+    if client.uploader is not None:
+        add("upload_waiters", len(client.uploader.waiters), _size_of(client.uploader.waiters))
+        add("hash_cache", len(client.uploader.cache.entries), _size_of(client.uploader.cache.entries))
+    if client.downloader is not None:
+        add("download_cache", len(client.downloader.cache), client.downloader.cached_size)
+        add("download_waiters", len(client.downloader.waiters) + len(client.downloader.loading),
+            _size_of(client.downloader.waiters) + _size_of(client.downloader.loading))
+    if client.searchIndex is not None:
+        # 数据库的页数 * 页大小；":memory:" 的时候全部在内存里，否则主要是磁盘上的文件
+        db = client.searchIndex.db
+        pages = db.execute("PRAGMA page_count").fetchone()[0] * db.execute("PRAGMA page_size").fetchone()[0]
+        add("search_index", client.searchIndex.count(), pages)
+    if client.outbox is not None:
+        pending = client.outbox.pending
+        add("outbox", len(pending), _size_of(pending) + sum(len(data) for data in pending.values()))
+    if client.conversations is not None:
+        convs = client.conversations.convs
+        add("conversations", len(convs), _size_of(convs) + sum(
+            _size_of(conv) + _size_of(conv.preview) + _size_of(conv.unread_ids) for conv in convs.values()))
+    return report
+
+
+def memory_report(client, limit=10, frames=1):
+    '''
+    tracemalloc 还没有启动时先启动，之后的分配才会被统计，所以第一次的结果通常是空的
+    traced 里是 SDK 各个源文件上分配、目前仍然存活的内存，top 是其中最大的几行
+    '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, os.path.join(_SDK_DIR, "*"))])
+    by_file = {}
+    for stat in snapshot.statistics("filename"):
+        name = os.path.relpath(stat.traceback[0].filename, _SDK_DIR)
+        by_file[name] = {"bytes": stat.size, "blocks": stat.count}
+    top = [{"where": f"{os.path.relpath(s.traceback[0].filename, _SDK_DIR)}:{s.traceback[0].lineno}",
+            "bytes": s.size, "blocks": s.count}
+           for s in snapshot.statistics("lineno")[:limit]]
+    return {"components": component_report(client), "traced": by_file, "top": top}
+
+
+def stop_memory_tracing():
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+##################################################################
+def install_signal_handler(client, signum=None):
+    '''
+    收到信号时：还没有打开统计就打开（同时开始 tracemalloc）；已经打开了就输出报告并关闭
+    在事件循环里调用时用 loop.add_signal_handler，否则用 signal.signal
+    '''
+    if signum is None:
+        signum = signal.SIGUSR1
+
+    def toggle(*_):
+        if client.profiler is None:
+            client.enable_profiling()
+            tracemalloc.start()
+            logger.warning("profiling enabled")
+        else:
+            logger.warning("profile: %s", client.get_profile())
+            logger.warning("memory: %s", memory_report(client))
+            client.disable_profiling()
+            stop_memory_tracing()
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signum, toggle)
+    except (RuntimeError, NotImplementedError):
+        signal.signal(signum, toggle)
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    令牌桶：rate 为每秒补充的令牌数，capacity 为桶容量（允许的突发量）
+    acquire 时先预定令牌，令牌可以透支为负数，调用方按欠账时间异步等待，
+    这样等待者按先后顺序排队，也不依赖某个具体的事件循环，可以跨会话、跨线程共享
+    '''
+    def __init__(self, rate, capacity=None, min_rate=None, recover_seconds=30.0):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.min_rate = float(min_rate if min_rate is not None else rate / 16)
+        self.recover_seconds = recover_seconds   # 收紧后大约多久线性恢复到 base_rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last
+        if elapsed <= 0:
+            return
+        self.last = now
+        if self.rate < self.base_rate and self.recover_seconds > 0:
+            step = self.base_rate * elapsed / self.recover_seconds
+            self.rate = min(self.base_rate, self.rate + step)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def reserve(self, n=1):
+        """Take n tokens and return how many seconds the caller has to wait."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    async def acquire(self, n=1):
+        delay = self.reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def set_rate(self, rate, capacity=None):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.base_rate = float(rate)
+            self.rate = float(rate)
+            if capacity is not None:
+                self.capacity = float(capacity)
+            self.tokens = min(self.tokens, self.capacity)
+
+    # 服务端提示限流时收紧速率（乘性减小），之后随时间线性恢复
+    def tighten(self, factor=0.5):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate * factor)
+            self.tokens = min(self.tokens, 0.0)
+
+    def get_rate(self):
+        return self.rate
+
+
+class RateLimiter:
+    '''
+    发送限流：按 ComMsgType 的桶 + 每个连接一个总桶 + 进程内所有会话共享的全局桶
+    没有配置任何限制的时候 acquire 直接返回
+    '''
+    global_bucket = None   # 进程级别，所有 BirdTalkClient 共享
+
+    def __init__(self, rate=None, capacity=None):
+        self.conn_bucket = TokenBucket(rate, capacity) if rate else None
+        self.type_buckets = {}
+        self.throttle_codes = set()
+        self.tighten_factor = 0.5
+
+    @classmethod
+    def set_global_limit(cls, rate, capacity=None):
+        if rate:
+            cls.global_bucket = TokenBucket(rate, capacity)
+        else:
+            cls.global_bucket = None
+
+    def set_connection_limit(self, rate, capacity=None):
+        self.conn_bucket = TokenBucket(rate, capacity) if rate else None
+
+    def set_limit(self, msg_type, rate, capacity=None):
+        if rate:
+            self.type_buckets[msg_type] = TokenBucket(rate, capacity)
+        else:
+            self.type_buckets.pop(msg_type, None)
+
+    # 哪些 MsgError.code 表示被服务端限流了
+    def set_throttle_codes(self, codes, factor=0.5):
+        self.throttle_codes = set(codes)
+        self.tighten_factor = factor
+
+    def _buckets(self, msg_type):
+        bucket = self.type_buckets.get(msg_type)
+        if bucket is not None:
+            yield bucket
+        if self.conn_bucket is not None:
+            yield self.conn_bucket
+        if RateLimiter.global_bucket is not None:
+            yield RateLimiter.global_bucket
+
+    async def acquire(self, msg_type, n=1):
+        delay = 0.0
+        for bucket in self._buckets(msg_type):
+            delay = max(delay, bucket.reserve(n))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def on_error_code(self, code) -> bool:
+        if code not in self.throttle_codes:
+            return False
+        for bucket in self.type_buckets.values():
+            bucket.tighten(self.tighten_factor)
+        if self.conn_bucket is not None:
+            self.conn_bucket.tighten(self.tighten_factor)
+        if RateLimiter.global_bucket is not None:
+            RateLimiter.global_bucket.tighten(self.tighten_factor)
+        print(f"server throttled us (code={code}), send rate tightened")
+        return True
@@ -0,0 +1,62 @@
+import struct
+import time
+
+# 录制文件格式：
+# 文件头  magic(4) + version(1)
+# 每一帧  direction(1) + 相对录制开始的单调时钟纳秒(8) + 长度(4) + 原始帧数据
+MAGIC = b"BTRC"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sB")
+_RECORD = struct.Struct("<BQI")
+
+DIR_IN = 0
+DIR_OUT = 1
+
+
+class FrameRecorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(_HEADER.pack(MAGIC, FORMAT_VERSION))
+        self.start_ns = time.monotonic_ns()
+        self.count = 0
+
+    def record(self, direction, data):
+        if self.file is None:
+            return
+        ts = time.monotonic_ns() - self.start_ns
+        self.file.write(_RECORD.pack(direction, ts, len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            print(f"{self.count} frames recorded to {self.filename}.")
+
+
+def read_frames(filename):
+    """Yield (direction, timestamp_ns, data) for every frame in a recording."""
+    with open(filename, 'rb') as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"'{filename}' is not a frame recording")
+        magic, version = _HEADER.unpack(header)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"'{filename}' is not a frame recording")
+        while True:
+            head = f.read(_RECORD.size)
+            if not head:
+                return
+            if len(head) < _RECORD.size:
+                raise ValueError(f"truncated frame header in '{filename}'")
+            direction, ts, size = _RECORD.unpack(head)
+            data = f.read(size)
+            if len(data) < size:
+                raise ValueError(f"truncated frame in '{filename}'")
+            yield direction, ts, data
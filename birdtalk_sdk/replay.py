@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+from .recorder import read_frames, DIR_IN
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+async def replay(filename, client, realtime=False, speed=1.0, quiet=True):
+    '''
+    把录制文件中的入站帧重新喂给 client 的解码和 dispatch_msg，统计处理吞吐和延迟
+    realtime=False 时全速回放；为 True 时按录制的时间间隔回放（speed 为倍速）
+    回放过程中 client 发出的消息直接丢弃，只计数
+    返回统计结果 dict，时间单位为毫秒
+    '''
+    sent = 0
+
+    async def discard(message):
+        nonlocal sent
+        sent += 1
+
+    client.client.send_message = discard
+
+    latencies = []
+    by_type = {}
+    total_bytes = 0
+    first_ts = None
+    wall_start = time.perf_counter()
+    out = open(os.devnull, 'w') if quiet else None
+    try:
+        with contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext():
+            for direction, ts, data in read_frames(filename):
+                if direction != DIR_IN:
+                    continue
+                if realtime:
+                    if first_ts is None:
+                        first_ts = ts
+                    due = wall_start + (ts - first_ts) / 1e9 / speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                begin = time.perf_counter()
+                msg = client.deserialize_protobuf(data)
+                await client.dispatch_msg(msg)
+                cost = (time.perf_counter() - begin) * 1000
+                latencies.append(cost)
+                total_bytes += len(data)
+                by_type[msg.msgType] = by_type.get(msg.msgType, 0) + 1
+    finally:
+        if out is not None:
+            out.close()
+
+    elapsed = time.perf_counter() - wall_start
+    latencies.sort()
+    return {
+        "frames": len(latencies),
+        "bytes": total_bytes,
+        "sent": sent,
+        "elapsed_ms": elapsed * 1000,
+        "msgs_per_sec": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": _percentile(latencies, 50),
+        "p90_ms": _percentile(latencies, 90),
+        "p99_ms": _percentile(latencies, 99),
+        "max_ms": latencies[-1] if latencies else 0.0,
+        "by_type": by_type,
+    }
+
+
+def print_report(stats):
+    print(f"frames: {stats['frames']}  bytes: {stats['bytes']}  replies sent: {stats['sent']}")
+    print(f"elapsed: {stats['elapsed_ms']:.1f} ms  throughput: {stats['msgs_per_sec']:.0f} msg/s")
+    print(f"latency p50={stats['p50_ms']:.3f} p90={stats['p90_ms']:.3f} "
+          f"p99={stats['p99_ms']:.3f} max={stats['max_ms']:.3f} ms")
+    for msg_type, count in sorted(stats["by_type"].items()):
+        print(f"  msgType {msg_type}: {count}")
+
+
+def main():
+    from .birdtalk_client import BirdTalkClient
+
+    parser = argparse.ArgumentParser(description="Replay a recorded BirdTalk session")
+    parser.add_argument("filename")
+    parser.add_argument("--name", default="replay", help="key name used to load key files")
+    parser.add_argument("--realtime", action="store_true", help="keep the recorded timing")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--verbose", action="store_true", help="keep handler output")
+    args = parser.parse_args()
+
+    client = BirdTalkClient("ws://replay", args.name, inbox_size=0)
+    stats = asyncio.run(replay(args.filename, client, args.realtime, args.speed, not args.verbose))
+    print_report(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+'''
+本地聊天记录全文检索（服务端不支持关键字搜索），基于 SQLite FTS5
+
+中日韩文字没有空格分词，这里把连续的 CJK 字符切成重叠的二元组（"你好世界" -> 你好 好世 世界），
+另外每个字单独放在 chars 列里，用来查询单个字；其他文字按单词小写
+查询时用同样的方法切分，CJK 片段组成短语查询，单个字查 chars 列，单词做前缀匹配
+
+    index = SearchIndex("search_robin.db")
+    client.set_search_index(index)
+    rows = index.search("会议 notes", conv=(ChatType.ChatTypeP2P, 10003), limit=20)
+'''
+import re
+import sqlite3
+from . import msg_pb2
+
+# 假名、汉字、韩文
+_CJK = r"぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+# 单词里不能包含 CJK 字符，否则 "ok明天" 会成为一个词
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|(?:(?![{_CJK}])[^\W_])+")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+
+def _split(text):
+    """Yield (is_cjk, run, [tokens]) for every run in text."""
+    for match in _TOKEN_RE.finditer(text):
+        run = match.group(0)
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                yield True, run, [run]
+            else:
+                yield True, run, [run[i:i + 2] for i in range(len(run) - 1)]
+        else:
+            yield False, run, [run.lower()]
+
+
+def tokenize(text):
+    """Return the (tokens, chars) column values for text."""
+    tokens = []
+    chars = []
+    for is_cjk, run, run_tokens in _split(text):
+        tokens.extend(run_tokens)
+        if is_cjk:
+            chars.extend(run)
+    return " ".join(tokens), " ".join(chars)
+
+
+def build_query(text):
+    parts = []
+    for is_cjk, run, tokens in _split(text):
+        if is_cjk and len(run) == 1:
+            parts.append(f'chars : "{run}"')
+        elif is_cjk:
+            parts.append('tokens : "' + " ".join(tokens) + '"')
+        else:
+            parts.append('tokens : "' + tokens[0].replace('"', '""') + '"*')
+    return " AND ".join(parts)
+
+
+class SearchIndex:
+    '''
+    filename 为 ":memory:" 时只在内存中；写入在同一个事务中累积，每 commit_every 条提交一次
+    '''
+    def __init__(self, filename=":memory:", commit_every=200):
+        self.db = sqlite3.connect(filename)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS chat_msg(
+                msg_id INTEGER PRIMARY KEY,
+                chat_type INTEGER NOT NULL,
+                peer_id INTEGER NOT NULL,
+                from_id INTEGER NOT NULL,
+                tm INTEGER NOT NULL,
+                text TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS chat_msg_conv ON chat_msg(chat_type, peer_id, tm);
+        """)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(chat_fts)")]
+        if columns != ["tokens", "chars"]:
+            self.rebuild()
+
+    def rebuild(self):
+        """Recreate the full-text table from the stored messages."""
+        self.db.execute("DROP TABLE IF EXISTS chat_fts")
+        self.db.execute("CREATE VIRTUAL TABLE chat_fts USING fts5(tokens, chars, tokenize='unicode61')")
+        for msg_id, text in self.db.execute("SELECT msg_id, text FROM chat_msg").fetchall():
+            self.db.execute("INSERT INTO chat_fts(rowid, tokens, chars) VALUES(?,?,?)", (msg_id,) + tokenize(text))
+        self.flush()
+
+    def _written(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.flush()
+
+    def add(self, msg_id, chat_type, peer_id, from_id, tm, text):
+        if not msg_id or not text:
+            return
+        exists = self.db.execute("SELECT 1 FROM chat_msg WHERE msg_id=?", (msg_id,)).fetchone()
+        if exists:
+            return     # 推送和同步的结果会有重复
+        self.db.execute("INSERT INTO chat_msg VALUES(?,?,?,?,?,?)",
+                        (msg_id, chat_type, peer_id, from_id, tm, text))
+        self.db.execute("INSERT INTO chat_fts(rowid, tokens, chars) VALUES(?,?,?)", (msg_id,) + tokenize(text))
+        self._written()
+
+    def delete(self, msg_id):
+        cur = self.db.execute("DELETE FROM chat_msg WHERE msg_id=?", (msg_id,))
+        if cur.rowcount:
+            self.db.execute("DELETE FROM chat_fts WHERE rowid=?", (msg_id,))
+            self._written()
+
+    def flush(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def count(self):
+        return self.db.execute("SELECT count(*) FROM chat_msg").fetchone()[0]
+
+    def search(self, text, conv=None, since=None, until=None, limit=20, offset=0):
+        '''
+        按相关度排序，conv 为 (chatType, 对方用户或群组 id)，since/until 为 MsgChat.tm 的范围
+        返回 [{"msgId", "chatType", "peerId", "fromId", "tm", "text", "score"}]
+        '''
+        query = build_query(text)
+        if not query:
+            return []
+        sql = ["SELECT m.msg_id, m.chat_type, m.peer_id, m.from_id, m.tm, m.text, bm25(chat_fts) AS score"
+               " FROM chat_fts JOIN chat_msg m ON m.msg_id = chat_fts.rowid"
+               " WHERE chat_fts MATCH ?"]
+        args = [query]
+        if conv is not None:
+            sql.append(" AND m.chat_type=? AND m.peer_id=?")
+            args.extend(conv)
+        if since is not None:
+            sql.append(" AND m.tm>=?")
+            args.append(since)
+        if until is not None:
+            sql.append(" AND m.tm<=?")
+            args.append(until)
+        sql.append(" ORDER BY score LIMIT ? OFFSET ?")
+        args.extend((limit, offset))
+        rows = self.db.execute("".join(sql), args).fetchall()
+        keys = ("msgId", "chatType", "peerId", "fromId", "tm", "text", "score")
+        return [dict(zip(keys, row)) for row in rows]
+
+    ##################################################################
+    # 由 BirdTalkClient 调用，conv 为 (chatType, 对方 id)
+    def on_chat(self, chat: msg_pb2.MsgChat, conv):
+        if chat.msgType == msg_pb2.ChatMsgType.DELETE:
+            if chat.refMessageId:
+                self.delete(chat.refMessageId)
+            return
+        if chat.msgType != msg_pb2.ChatMsgType.TEXT or chat.encType != msg_pb2.EncryptType.PLAIN:
+            return
+        text = chat.data.decode('utf-8', errors='replace')
+        self.add(chat.msgId, conv[0], conv[1], chat.fromId, chat.tm, text)
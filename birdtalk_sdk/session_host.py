@@ -0,0 +1,361 @@
+'''
+多进程的会话宿主：一台机器上运行成百上千个机器人身份（每个身份有自己的 name 和秘钥文件）
+
+    host = SessionHost(workers=8)
+    host.add_identity(10003, "robin", "wss://127.0.0.1/ws?code=plain", pwd="123456")
+    host.add_identity(10004, "bot4", "wss://127.0.0.1/ws?code=plain", pwd="123456", inbox_size=100,
+                      rate_limits={ComMsgType.MsgTChatMsg: (5, 10)})   # 其余关键字参数传给 BirdTalkClient
+    host.start()
+    host.send_chat(10003, 10001, "hello")
+    print(host.get_metrics())
+    host.stop()
+
+- 身份按 user id 做一致性哈希分配到 worker 进程，每个 worker 一个事件循环
+- worker 退出后，它的身份迁移到其他 worker（一致性哈希只移动这部分）；respawn=True 时会补一个新 worker
+- 对某个身份的操作通过 multiprocessing 队列发给它所在的 worker，只投递不等待结果
+- worker 定期上报指标，由 SessionHost 汇总
+'''
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+
+class HashRing:
+    '''
+    一致性哈希环，每个节点放 replicas 个虚拟节点
+    '''
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.keys = []      # 排好序的哈希值
+        self.owners = {}    # 哈希值 -> 节点
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash_key(key):
+        digest = hashlib.md5(str(key).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def add(self, node):
+        for i in range(self.replicas):
+            h = self.hash_key(f"{node}#{i}")
+            if h in self.owners:
+                continue
+            bisect.insort(self.keys, h)
+            self.owners[h] = node
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            h = self.hash_key(f"{node}#{i}")
+            if self.owners.get(h) == node:
+                del self.owners[h]
+                self.keys.pop(bisect.bisect_left(self.keys, h))
+
+    def get(self, key):
+        if not self.keys:
+            return None
+        index = bisect.bisect(self.keys, self.hash_key(key)) % len(self.keys)
+        return self.owners[self.keys[index]]
+
+    def __len__(self):
+        return len(self.keys) // self.replicas if self.replicas else 0
+
+
+##################################################################
+# worker 进程
+class _WorkerHost:
+    def __init__(self, worker_id, commands, results, metrics_interval, reconnect_delay):
+        self.worker_id = worker_id
+        self.commands = commands
+        self.results = results
+        self.metrics_interval = metrics_interval
+        self.reconnect_delay = reconnect_delay
+        self.sessions = {}    # user_id -> (BirdTalkClient, task)
+        self.counters = {"commands": 0, "errors": 0, "received": 0, "connects": 0}
+        self.running = True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        metrics_task = asyncio.create_task(self._report_metrics())
+        try:
+            while self.running:
+                command = await loop.run_in_executor(None, self.commands.get)
+                await self._handle(command)
+        finally:
+            metrics_task.cancel()
+            for client, task in list(self.sessions.values()):
+                client.close()
+                task.cancel()
+            self._send_metrics()
+
+    async def _handle(self, command):
+        op = command[0]
+        if op == "stop":
+            self.running = False
+        elif op == "add":
+            self._add(command[1])
+        elif op == "remove":
+            session = self.sessions.pop(command[1], None)
+            if session is not None:
+                session[0].close()
+                session[1].cancel()
+        elif op == "call":
+            _, user_id, method, args = command
+            session = self.sessions.get(user_id)
+            if session is None:
+                self.counters["errors"] += 1
+                print(f"worker {self.worker_id}: no session for {user_id}")
+                return
+            self.counters["commands"] += 1
+            asyncio.create_task(self._call(session[0], method, args))
+
+    async def _call(self, client, method, args):
+        try:
+            await getattr(client, method)(*args)
+        except Exception as e:
+            self.counters["errors"] += 1
+            print(f"worker {self.worker_id}: {method} failed: {e!r}")
+
+    def _add(self, identity):
+        from .birdtalk_client import BirdTalkClient, ClientState
+
+        user_id = identity["user_id"]
+        if user_id in self.sessions:
+            return
+        client = BirdTalkClient(identity["uri"], identity["name"], **identity.get("options", {}))
+        for msg_type, (rate, capacity) in identity.get("rate_limits", {}).items():
+            client.set_rate_limit(msg_type, rate, capacity)
+
+        async def on_state(state, sub_state):
+            if state == ClientState.WAIT_LOGIN and sub_state != ClientState.LOGIN_FAIL:
+                await client.login(identity.get("mode", "id"), user_id, identity.get("pwd", ""))
+
+        client.set_state_callback(on_state)
+        task = asyncio.create_task(self._keep_alive(user_id, client))
+        self.sessions[user_id] = (client, task)
+
+    # 连接断开后按退避时间重连，直到这个身份被移走
+    async def _keep_alive(self, user_id, client):
+        subscriber = client.add_msg_subscriber()
+        counter = asyncio.create_task(self._count_received(subscriber))
+        delay = self.reconnect_delay
+        try:
+            while self.running and user_id in self.sessions:
+                self.counters["connects"] += 1
+                started = time.monotonic()
+                await client.start()
+                if time.monotonic() - started > 60:
+                    delay = self.reconnect_delay
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        finally:
+            counter.cancel()
+            client.remove_msg_subscriber(subscriber)
+
+    async def _count_received(self, subscriber):
+        while True:
+            msg = await subscriber.get()
+            if msg is not None:
+                self.counters["received"] += 1
+
+    def _send_metrics(self):
+        from .birdtalk_client import ClientState
+
+        metrics = dict(self.counters)
+        metrics["sessions"] = len(self.sessions)
+        metrics["ready"] = sum(1 for client, _ in self.sessions.values()
+                               if client.client_state == ClientState.READY)
+        metrics["pid"] = os.getpid()
+        self.results.put(("metrics", self.worker_id, metrics))
+
+    async def _report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self._send_metrics()
+
+
+def _worker_main(worker_id, commands, results, metrics_interval, reconnect_delay):
+    host = _WorkerHost(worker_id, commands, results, metrics_interval, reconnect_delay)
+    try:
+        asyncio.run(host.run())
+    except KeyboardInterrupt:
+        pass
+
+
+##################################################################
+class SessionHost:
+    def __init__(self, workers=None, metrics_interval=5.0, reconnect_delay=1.0,
+                 respawn=True, replicas=64):
+        self.worker_count = workers or os.cpu_count() or 1
+        self.metrics_interval = metrics_interval
+        self.reconnect_delay = reconnect_delay
+        self.respawn = respawn
+        self.ctx = multiprocessing.get_context("spawn")
+        self.results = self.ctx.Queue()
+        self.ring = HashRing(replicas=replicas)
+        self.workers = {}       # worker_id -> (process, command queue)
+        self.started_at = {}    # worker_id -> 启动时间
+        self.respawn_due = []   # 待补充的 worker 的启动时间点
+        self.identities = {}    # user_id -> identity dict
+        self.owner = {}         # user_id -> worker_id
+        self.metrics = {}       # worker_id -> 最近一次上报
+        self.next_worker_id = 0
+        self.lock = threading.RLock()
+        self.monitor_thread = None
+        self.running = False
+
+    # client_options 原样传给 worker 里的 BirdTalkClient（inbox_size、record_file 等），需要可以 pickle
+    # rate_limits: {msgType: (每秒条数, 突发条数)}
+    def add_identity(self, user_id, name, uri, pwd="", mode="id", rate_limits=None, **client_options):
+        identity = {"user_id": user_id, "name": name, "uri": uri, "pwd": pwd, "mode": mode,
+                    "rate_limits": dict(rate_limits or {}), "options": client_options}
+        with self.lock:
+            self.identities[user_id] = identity
+            if self.running:
+                self._assign(user_id)
+
+    def remove_identity(self, user_id):
+        with self.lock:
+            self.identities.pop(user_id, None)
+            worker_id = self.owner.pop(user_id, None)
+            if worker_id in self.workers:
+                self.workers[worker_id][1].put(("remove", user_id))
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            for _ in range(self.worker_count):
+                self._spawn_worker()
+            self._rebalance()
+        self.monitor_thread = threading.Thread(target=self._monitor, name="session-host-monitor", daemon=True)
+        self.monitor_thread.start()
+
+    def _spawn_worker(self):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        commands = self.ctx.Queue()
+        process = self.ctx.Process(
+            target=_worker_main, name=f"birdtalk-worker-{worker_id}",
+            args=(worker_id, commands, self.results, self.metrics_interval, self.reconnect_delay),
+            daemon=True)
+        process.start()
+        self.workers[worker_id] = (process, commands)
+        self.started_at[worker_id] = time.monotonic()
+        self.ring.add(worker_id)
+        return worker_id
+
+    def _assign(self, user_id):
+        target = self.ring.get(user_id)
+        current = self.owner.get(user_id)
+        if target == current:
+            return
+        if current in self.workers:
+            self.workers[current][1].put(("remove", user_id))
+        if target is None:
+            self.owner.pop(user_id, None)
+            return
+        self.owner[user_id] = target
+        self.workers[target][1].put(("add", self.identities[user_id]))
+
+    # 按当前的哈希环，把所有归属变化的身份迁移过去
+    def _rebalance(self):
+        for user_id in list(self.identities):
+            self._assign(user_id)
+
+    def _on_worker_dead(self, worker_id):
+        process, commands = self.workers.pop(worker_id)
+        print(f"worker {worker_id} (pid {process.pid}) exited with {process.exitcode}, rebalancing")
+        self.ring.remove(worker_id)
+        self.metrics.pop(worker_id, None)
+        uptime = time.monotonic() - self.started_at.pop(worker_id)
+        for user_id, owner in list(self.owner.items()):
+            if owner == worker_id:
+                del self.owner[user_id]
+        if self.respawn and self.running:
+            # 刚启动就退出的 worker 延迟补充，避免反复崩溃时不停地拉起进程
+            delay = 0 if uptime > 10 else 5
+            self.respawn_due.append(time.monotonic() + delay)
+        self._rebalance()
+
+    def _monitor(self):
+        while self.running:
+            self.poll(timeout=0.5)
+
+    def poll(self, timeout=0.0):
+        """Collect worker reports and handle dead workers."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self.results.get(timeout=remaining)
+                else:
+                    item = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] == "metrics":
+                with self.lock:
+                    if item[1] in self.workers:
+                        self.metrics[item[1]] = item[2]
+        with self.lock:
+            if not self.running:
+                return
+            for worker_id, (process, _) in list(self.workers.items()):
+                if not process.is_alive():
+                    self._on_worker_dead(worker_id)
+            now = time.monotonic()
+            due = [t for t in self.respawn_due if t <= now]
+            if due:
+                self.respawn_due = [t for t in self.respawn_due if t > now]
+                for _ in due:
+                    self._spawn_worker()
+                self._rebalance()
+
+    ##################################################################
+    # 把操作发给身份所在的 worker，method 为 BirdTalkClient 的协程方法名
+    def call(self, user_id, method, *args):
+        with self.lock:
+            worker_id = self.owner.get(user_id)
+            if worker_id is None:
+                raise KeyError(f"identity {user_id} is not hosted")
+            self.workers[worker_id][1].put(("call", user_id, method, args))
+
+    def send_chat(self, user_id, to_id, data, msg_type=None, chat_type=None):
+        self.call(user_id, "send_chat", to_id, data, msg_type, chat_type)
+
+    def get_owner(self, user_id):
+        return self.owner.get(user_id)
+
+    def get_metrics(self):
+        with self.lock:
+            total = {"workers": len(self.workers), "identities": len(self.identities)}
+            for metrics in self.metrics.values():
+                for key, value in metrics.items():
+                    if key != "pid":
+                        total[key] = total.get(key, 0) + value
+            total["per_worker"] = {wid: dict(m) for wid, m in self.metrics.items()}
+            return total
+
+    def stop(self, timeout=5.0):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            workers = list(self.workers.values())
+        for _, commands in workers:
+            commands.put(("stop",))
+        for process, _ in workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        if self.monitor_thread is not None:
+            self.monitor_thread.join(timeout)
+        self.workers.clear()
+        self.owner.clear()
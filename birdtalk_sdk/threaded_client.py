@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+from .birdtalk_client import BirdTalkClient
+
+
+class ThreadedClient:
+    '''
+    给非 asyncio 的程序（Django、线程池里的 worker 等）使用的门面：
+    BirdTalkClient 运行在一个独立线程的事件循环里，一个进程保持一个长连接
+    任意线程都可以提交发送，返回 concurrent.futures.Future
+
+    跨线程交接是批量的：提交只是加锁追加到队列，只有队列从空变为非空时才调用一次
+    call_soon_threadsafe 唤醒事件循环，循环线程一次取走整批，按提交顺序各自启动一个任务，
+    一个等待限流或者上传的提交不会挡住其他的提交
+    连接断开后按 reconnect_delay 到 max_reconnect_delay 指数退避重连，直到调用 stop()
+
+        tc = ThreadedClient("wss://127.0.0.1/ws?code=plain", "robin")
+        tc.client.set_state_callback(on_state)   # 回调在循环线程里执行
+        tc.start()
+        tc.send_chat(10003, "hello").result(timeout=5)
+        for msg in tc.messages(timeout=1): ...
+        tc.stop()
+    '''
+    def __init__(self, uri, name, max_incoming=1000, reconnect_delay=1.0, max_reconnect_delay=30.0, **kwargs):
+        self.client = BirdTalkClient(uri, name, **kwargs)
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = collections.deque()   # (coroutine function, args, future)
+        self.wakeup_scheduled = False
+        self.wakeup = None                    # asyncio.Event，循环线程里创建
+        self.stop_event = None                # asyncio.Event，打断重连前的等待
+        self.tasks = set()                    # 正在执行的提交
+        self.closed = False                   # 循环线程已经退出，新的提交直接失败
+        self.max_incoming = max_incoming
+        self.incoming = None                  # queue.Queue，第一次调用 messages() 时创建
+        self.stopped = False
+
+    def start(self, timeout=None):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name="birdtalk-loop", daemon=True)
+        self.thread.start()
+        if not self.ready.wait(timeout):
+            raise TimeoutError("event loop thread did not start")
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        self.wakeup = asyncio.Event()
+        self.stop_event = asyncio.Event()
+        submit_task = asyncio.create_task(self._process_submissions())
+        self.ready.set()
+        try:
+            delay = self.reconnect_delay
+            while not self.stopped:
+                started = time.monotonic()
+                await self.client.start()
+                if self.stopped:
+                    break
+                if time.monotonic() - started > self.max_reconnect_delay:
+                    delay = self.reconnect_delay    # 连接保持了一段时间，重新开始退避
+                print(f"ThreadedClient: connection ended, reconnecting in {delay:.1f}s")
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, self.max_reconnect_delay)
+        finally:
+            self.client.close()
+            with self.lock:
+                self.closed = True
+            submit_task.cancel()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(submit_task, *self.tasks, return_exceptions=True)
+            self._cancel_pending()
+            if self.incoming is not None:
+                self._close_incoming()
+
+    ##################################################################
+    # 提交
+    def submit(self, coro_func, *args) -> concurrent.futures.Future:
+        """Run coro_func(*args) on the client loop; any thread may call this."""
+        if self.loop is None:
+            raise RuntimeError("ThreadedClient.start() must be called first")
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.stopped or self.closed:
+                future.set_exception(RuntimeError("client is stopped"))
+                return future
+            self.pending.append((coro_func, args, future))
+            need_wakeup = not self.wakeup_scheduled
+            self.wakeup_scheduled = True
+        if need_wakeup:
+            try:
+                self.loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError:
+                # 循环刚好在这之间退出，_cancel_pending 已经处理了这个 future
+                pass
+        return future
+
+    async def _process_submissions(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                batch = self.pending
+                self.pending = collections.deque()
+                self.wakeup_scheduled = False
+            for coro_func, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    task = asyncio.ensure_future(coro_func(*args))
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                self.tasks.add(task)
+                task.add_done_callback(lambda t, f=future: self._finish(t, f))
+
+    def _finish(self, task, future):
+        self.tasks.discard(task)
+        if task.cancelled():
+            future.set_exception(RuntimeError("client is stopped"))
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def _cancel_pending(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = collections.deque()
+        for _, _, future in batch:
+            future.cancel()
+
+    def send(self, message):
+        return self.submit(self.client.send, message)
+
+    def send_chat(self, to_id, data, msg_type=None, chat_type=None):
+        return self.submit(self.client.send_chat, to_id, data, msg_type, chat_type)
+
+    def login(self, mode, user_id, pwd):
+        return self.submit(self.client.login, mode, user_id, pwd)
+
+    ##################################################################
+    # 接收
+    def messages(self, timeout=None):
+        '''
+        同步迭代收到的消息；timeout 秒内没有新消息就结束迭代，None 表示一直等到客户端停止
+        第一次调用时订阅，订阅之前收到的消息不会出现在这里
+        '''
+        if self.incoming is None:
+            self.incoming = queue.Queue(self.max_incoming)
+            self.submit(self._subscribe).result()
+        return self._iter_incoming(timeout)
+
+    def _iter_incoming(self, timeout):
+        while True:
+            try:
+                msg = self.incoming.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if msg is None:
+                return
+            yield msg
+
+    async def _subscribe(self):
+        # 订阅是同步完成的，转发放在独立的任务里，不占用提交队列
+        subscriber = self.client.add_msg_subscriber()
+        asyncio.create_task(self._pump_loop(subscriber))
+
+    async def _pump_loop(self, subscriber):
+        try:
+            while True:
+                msg = await subscriber.get()
+                if msg is None:
+                    if self.stopped:
+                        return
+                    continue     # 连接断开了，重连以后继续转发
+                while not self._put_incoming(msg):
+                    # 同步消费方跟不上，反压到订阅队列，最终暂停读 socket
+                    await asyncio.sleep(0.005)
+        finally:
+            self.client.remove_msg_subscriber(subscriber)
+
+    def _put_incoming(self, msg):
+        try:
+            self.incoming.put_nowait(msg)
+            return True
+        except queue.Full:
+            return False
+
+    def _close_incoming(self):
+        # 结束标记一定要放进去，队列满了就丢掉最旧的一条
+        while not self._put_incoming(None):
+            try:
+                self.incoming.get_nowait()
+            except queue.Empty:
+                pass
+
+    ##################################################################
+    def stop(self, timeout=None):
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.loop is not None and not self.closed:
+            try:
+                self.loop.call_soon_threadsafe(self._stop_in_loop)
+            except RuntimeError:
+                pass     # 循环已经退出
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _stop_in_loop(self):
+        self.stop_event.set()
+        self.client.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
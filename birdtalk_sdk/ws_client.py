@@ -1,15 +1,31 @@
 import asyncio
-import websockets
 import ssl
+from .recorder import FrameRecorder, DIR_IN, DIR_OUT
 
 class WebSocketClient:
-    def __init__(self, uri):
+    '''
+    record_file: 如果设置了，收发的每一个二进制帧都会录制到这个文件，用于回放测试
+    '''
+    def __init__(self, uri, record_file=None):
         self.uri = uri
+        self.open_timeout = 10
         self.websocket = None
         self.stop_event = asyncio.Event()
         self.on_connect_callback = None
         self.on_disconnect_callback = None
         self.on_raw_message_callback = None
+        self.recorder = None
+        if record_file:
+            self.start_recording(record_file)
+
+    def start_recording(self, filename):
+        self.stop_recording()
+        self.recorder = FrameRecorder(filename)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
     
     def set_on_raw_message_callback(self, callback):
         self.on_raw_message_callback = callback
@@ -27,6 +43,8 @@ class WebSocketClient:
     #二进制编码消息
     async def handle_binary_message(self, message):
         #print(f"Received binary message: {message}")
+        if self.recorder is not None:
+            self.recorder.record(DIR_IN, message)
         if self.on_raw_message_callback:
             await self.on_raw_message_callback(message)
 
@@ -43,20 +61,29 @@ class WebSocketClient:
     async def send_message(self, message):
         if self.websocket:
             #print(f"Sending message: {message}")
+            if self.recorder is not None and isinstance(message, bytes):
+                self.recorder.record(DIR_OUT, message)
             await self.websocket.send(message)
         else:
             print("WebSocket is not connected")
 
 
-    async def start(self):
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
+    # 返回是否建立过连接，调用方据此决定是否换一个接入点
+    async def start(self) -> bool:
+        import websockets   # 按需加载，import 本模块不需要 websockets
 
+        ssl_context = None        # ws:// 不能传 ssl 参数
+        if self.uri.startswith("wss://"):
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+
+        connected = False
         try:
             print("Attempting to connect to WebSocket...")
-            async with websockets.connect(self.uri, ssl=ssl_context) as websocket:
+            async with websockets.connect(self.uri, ssl=ssl_context, open_timeout=self.open_timeout) as websocket:
                 self.websocket = websocket
+                connected = True
                 print("WebSocket connection established")
                 # Call on_connect_callback if set
                 if self.on_connect_callback:
@@ -87,6 +114,9 @@ class WebSocketClient:
                     self.on_disconnect_callback()
                 print("WebSocket connection closed")
             self.websocket = None
+            if self.recorder is not None:
+                self.recorder.flush()
+        return connected
              
                
 
@@ -94,4 +124,8 @@ class WebSocketClient:
         print("Stopping WebSocket client")
         self.stop_event.set()
 
+    # stop 之后再次 start 之前调用；start 自己不清除，避免 stop 在连接之前调用时被忽略
+    def reset(self):
+        self.stop_event.clear()
+
 